@@ -11,19 +11,60 @@ Author: Donald J Woodbury, University of Toronto'''
 
 from SingleBeadBrownianTools import *
 from MultipleBeadBrownian import *
+from BrownianFrames import *
+from BrownianTracks import *
+from BrownianCache import *
+from BrownianPreprocess import *
+from BrownianExport import *
+from BrownianMovie import *
+from BrownianProfile import *
+from BrownianCore import *
+from BrownianDisplay import *
+from BrownianThreshold import sweep_thresholds
 from Tkinter import *
 from tkSimpleDialog import askstring
 from tkFileDialog import asksaveasfilename, askopenfilename
 from PIL import Image, ImageSequence, ImageDraw, ImageOps
 from numpy import average
+from bisect import bisect_left
 import os
 import os.path
 
+#Shown above the frame until tracking starts.
+SELECT_TEXT = 'Select Spot Location (shift-click to choose several):'
+
+#Time between checks for messages from the worker thread, in ms.
+POLL_INTERVAL = 50
+
 class Spot_Track:
-    def __init__(self):
+    def __init__(self, localization = 'centroid', search = 'window', \
+                 temporal_window = 0, local_radius = 0, \
+                 progress = print_progress):
         '''Prompts the user to select an image sequence file and creates the
-        Tkinter window with bindings, scrollbars and images.'''
+        Tkinter window with bindings, scrollbars and images. 'localization' is
+        the method used to find the center of the spot, one of 'centroid',
+        'weighted' or 'gaussian' (see BrownianLocalize). 'search' is either
+        'window', which averages every dark pixel in a box of fixed size
+        around the last position, or 'predictive', which sizes the box from
+        the steps the spot has taken so far and follows the spot nearest to
+        where it is expected (see Spot_Predictor). temporal_window and
+        local_radius are the background corrections applied to the frames,
+        see BrownianPreprocess. 0 for none. 'progress' is called as the
+        tracking goes on (see BrownianProfile); by default it prints the
+        messages.'''
         
+        self.profile = Profile()
+        self.progress = progress
+        self.worker = None
+        self.worker_done = None
+        self.next_job = None
+        self.poll_id = None
+        self.localization = localization
+        self.search = search
+        self.temporal_window = temporal_window
+        self.local_radius = local_radius
+        self.cache = Detection_Cache()
+        self.all_tracks = None
         self.root = Tk()
         self.root.title('Spot Tracker')
 
@@ -40,7 +81,12 @@ class Spot_Track:
         #Results
 
         self.track = []
-        self.frames = []
+        self.tracks = []
+        self.positions = []
+        #The frames of the positions of each spot, to look them up by.
+        self.position_frames = []
+        self.seeds = []
+        self.overlay = None
         
         #Building the Tkinter window
         self.Draw_canvas()
@@ -58,15 +104,26 @@ class Spot_Track:
         frame = Frame(self.root)
         frame.pack()
         
-        self.label = Label(frame, text="Select Spot Location:", anchor = 'n')
+        self.label = Label(frame, text=SELECT_TEXT, anchor = 'n')
         self.label.pack()
         
-        self.canvas = Canvas(frame, width=self.im_size[0], height=self.im_size[1])
+        self.display = Display_Cache(self.im_seq)
+        self.canvas = Canvas(frame, width=self.display.size[0], \
+                             height=self.display.size[1])
         self.canvas.pack()
 
-        self.tkimg = ImageTk.PhotoImage(self.im_seq[0].convert('RGB'))
+        self.tkimg = ImageTk.PhotoImage(self.display.Get(0))
 
         self.im_id = self.canvas.create_image(0,0,image=self.tkimg,anchor="nw")
+        self.spot_markers = []
+        self.seed_markers = []
+
+    def Marker(self, x = 0, y = 0, colour = 'red', state = 'hidden'):
+        '''Returns a new square drawn on the canvas around the display point
+        (x, y), to mark a spot.'''
+        return self.canvas.create_rectangle(x-2, y-2, x+2, y+2, \
+                                            fill = colour, outline = colour, \
+                                            state = state)
 
     def Open_im_seq(self):
         '''Opens the sequence of images used for analysis. When called, this
@@ -84,30 +141,17 @@ class Spot_Track:
         if len(self.filename) == 0:
             return -1
 
-        self.im_seq = []
-
-        if self.filename[-3:] == 'tif' or self.filename[-3:] == 'gif':
-            im_seq = Image.open(self.filename)
-            i = 0
-            for frame in ImageSequence.Iterator(im_seq):
-                im = ImageSequence.Iterator(im_seq)[i]
-                self.im_seq.append(im.copy())
-                i += 1
-        else:
-            directory, im_name = os.path.split(self.filename)
-            im_num = int(''.join(s for s in im_name if s.isdigit()))
-            im_name = ''.join(s for s in im_name if not s.isdigit())[:-4]
-            
-            while os.path.isfile(directory+'/'+im_name+str(im_num)+'.jpg'):
-                image = Image.open(directory+'/'+im_name+str(im_num)+'.jpg')
-                self.im_seq.append(image)
-                im_num+=1
+        with self.profile.Stage('load'):
+            self.im_seq = preprocess(open_frames(self.filename), \
+                                     self.temporal_window, self.local_radius)
 
     def Open_new(self):
         '''Resets the program to its initial state and prompts the user to
         open a new image sequence.'''
         if self.Open_im_seq() == -1:
             return None
+        self.display.Close()
+        self.display = Display_Cache(self.im_seq)
         self.Reset()
 
     #_________________Sliders__________________#
@@ -119,38 +163,60 @@ class Spot_Track:
         self.frame_slider = Scale(self.root, command = self.Update_frame, \
                                   label="Frame Number:", \
                                   variable = self.frame_number,\
-                                  length=self.im_size[0], orient=HORIZONTAL, \
-                                  from_= 0, to=len(self.im_seq)-1)
+                                  length=self.display.size[0], \
+                                  orient=HORIZONTAL, from_= 0, to=len(self.im_seq)-1)
         self.frame_slider.pack()
 
         self.threshold = IntVar()
         self.threshold.set(128)
         self.threshold_slider = Scale(self.root, variable = self.threshold, \
-                                      label="Threshold:",length=self.im_size[0], \
+                                      label="Threshold:",\
+                                      length=self.display.size[0], \
                                       orient=HORIZONTAL, to=255)
         self.threshold_slider.pack()
+        self.suggest_button = Button(self.root, text = 'Suggest Threshold', \
+                                     command = self.Suggest_threshold)
+        self.suggest_button.pack()
 
         self.max_distance = IntVar()
         self.max_distance.set(30)
         self.max_dist_slider = Scale(self.root, variable = self.max_distance, \
                                      label='Maxiumum distance the spot may'+\
                                      ' travel between frames:',\
-                                     length=self.im_size[0], orient=HORIZONTAL,\
+                                     length=self.display.size[0], \
+                                     orient=HORIZONTAL,\
                                      to=100)
         self.max_dist_slider.pack()
 
     def Update_frame(self, event):
         '''Updates the frame displayed when the frame_slider is moved. If
         no analysis has been performed, the raw images will be displayed.
-        After the analysis, the spot location will be displayed.'''
+        After the analysis, the spot location, or all of the tracks, are drawn
+        over the frame.'''
         self.frame_num = min(self.frame_number.get(), len(self.im_seq)-1)
+        self.tkimg.paste(self.display.Get(self.frame_num))
+
+        for marker in self.spot_markers:
+            self.canvas.itemconfigure(marker, state = 'hidden')
         if not self.Tracking:
-            self.tkimg.paste(self.im_seq[self.frame_num])
+            return
         elif self.view_all_tracks_var.get():
-            self.tkimg.paste(self.all_track_frames[self.frame_num-\
-                                                   self.start_frame])
-        else:
-            self.tkimg.paste(self.frames[self.frame_num-self.start_frame])
+            if self.overlay is not None:
+                self.overlay.Show(self.frame_num)
+            return
+        elif self.overlay is not None:
+            self.overlay.Hide()
+
+        for (marker, positions, frames) in zip(self.spot_markers, \
+                                               self.positions, \
+                                               self.position_frames):
+            #Frames in which the spot was missing have no position.
+            k = bisect_left(frames, self.frame_num)
+            if k < len(positions) and positions[k][0] == self.frame_num:
+                x, y = positions[k][1]
+                x, y = x*self.display.scale, y*self.display.scale
+                self.canvas.coords(marker, x-2, y-2, x+2, y+2)
+                self.canvas.itemconfigure(marker, state = 'normal')
 
     #_________________Menus__________________#
 
@@ -165,6 +231,8 @@ class Spot_Track:
                                   command=self.Open_new)
         self.filemenu.add_command(label="Reset",\
                                   command=self.Reset)
+        self.filemenu.add_command(label="Stop Tracking",\
+                                  command=self.Stop_worker)
         self.view_all_tracks_var = IntVar()
         self.filemenu.add_checkbutton(label="View All Tracks",\
                                   command=self.View_all_tracks,\
@@ -172,10 +240,14 @@ class Spot_Track:
         self.filemenu.add_separator()
         self.filemenu.add_command(label="Save Track to File",\
                                   command=self.Save_file)
+        self.filemenu.add_command(label="Save All Tracks to File",\
+                                  command=self.Save_all_tracks)
         self.filemenu.add_command(label="Save Images",\
                                   command=self.Save_frames)
         self.filemenu.add_command(label="Plot",\
                                   command=self.Plot)
+        self.filemenu.add_command(label="Save Timing Report",\
+                                  command=self.Save_profile)
         self.filemenu.add_separator()
         self.filemenu.add_command(label="Exit", command=self.Close_window)
         
@@ -190,17 +262,24 @@ class Spot_Track:
         self.label.pack()
         self.canvas.pack()
         self.threshold_slider.pack()
+        self.suggest_button.pack()
         self.max_dist_slider.pack()
         self.frame_slider.config(from_ = 0, to = len(self.im_seq)-1)
         
         self.menu.delete(1,2)
 
+        self.Stop_worker(keep = False)
         self.Tracking = 0
         self.view_all_tracks_var.set(0)
 
         self.Update_frame(0)
         self.track = []
-        self.frames = []
+        self.tracks = []
+        self.positions = []
+        self.position_frames = []
+        self.Clear_markers()
+        self.all_tracks = None
+        self.Show_tracks(None)
         
         self.root.update()
         window_size = (int(self.root.winfo_reqwidth()),\
@@ -210,42 +289,95 @@ class Spot_Track:
     def View_all_tracks(self):
         '''Finds and displays all spot tracks found within the image.'''
         if not self.view_all_tracks_var.get():
+            self.Stop_worker()
             self.frame_slider.config(to = self.end_frame)
             self.Update_frame(0)
             
         else:
-            all_tracks = Multiple_Spot_Track(max_frames = 3,\
-                                max_dist = self.max_distance.get(),\
-                                threshold = self.threshold.get(),\
-                                start_frame = self.start_frame, \
-                                end_frame = None,\
-                                im_seq = self.im_seq)
-            self.all_track_frames = all_tracks.Draw_track()
+            self.Find_all_tracks(self.All_tracks_done)
             self.frame_slider.config(to = len(self.im_seq)-1)
-            
             self.Update_frame(0)
-        
+
+    def All_tracks_done(self, tracker):
+        '''Keeps the Multiple_Spot_Track found by View_all_tracks and draws
+        its tracks over the frames.'''
+        self.all_tracks = tracker
+        if tracker is not None:
+            self.Show_tracks(tracker.table)
+            self.Update_frame(None)
+        else:
+            self.view_all_tracks_var.set(0)
+
+    def Find_all_tracks(self, done):
+        '''Starts the multiple spot tracker on the sequence from the starting
+        frame, with the current settings, on a worker thread. done(tracker)
+        is called with the Multiple_Spot_Track at the end.'''
+        self.Start_worker(done, track_all_spots, self.im_seq, \
+                          self.start_frame, self.threshold.get(), \
+                          self.max_distance.get(), self.localization, \
+                          self.cache, writers = ())
+
+    def Show_tracks(self, table):
+        '''Replaces the tracks drawn over the frames with those in the track
+        table, or removes them if table is None.'''
+        if self.overlay is not None:
+            self.overlay.Delete()
+            self.overlay = None
+        if table is not None:
+            self.overlay = Track_Overlay(self.canvas, table, \
+                                         self.display.scale)
 
     #______________Event Bindings_______________#
     
     def Bindings(self):
         '''Defines the bindings in the tkinter window.'''
         self.canvas.bind("<Button-1>", self.Start_tracking)
+        self.canvas.bind("<Shift-Button-1>", self.Add_seed)
+        self.root.bind("<Return>", lambda event: self.Start_tracking(None))
+        self.root.bind("<Escape>", lambda event: self.Stop_worker())
         self.root.protocol("WM_DELETE_WINDOW", self.Close_window)
 
+    def Add_seed(self, event):
+        '''Adds the spot shift-clicked on to those to be followed, without
+        starting to track them yet.'''
+        if not self.Tracking:
+            self.seeds.append(self.display.To_frame(event.x, event.y))
+            self.seed_markers.append(self.Marker(event.x, event.y, 'blue', \
+                                                 'normal'))
+            self.label.config(text = SELECT_TEXT + ' (%d chosen)' % \
+                              len(self.seeds))
+
+    def Clear_markers(self):
+        '''Removes the marks of the spots chosen and followed.'''
+        for marker in self.seed_markers + self.spot_markers:
+            self.canvas.delete(marker)
+        self.seed_markers, self.spot_markers = [], []
+        self.seeds = []
+        self.label.config(text = SELECT_TEXT)
+
     def Start_tracking(self, event):
         '''Initializes the parameters for Spot tracking. First it defines the
-        initial location of the spot and the starting frame. It then removes
-        both the the label and threshold slider (since neither are needed for
-        displaying the spot track.) It then calls the Analysis function.'''
+        initial location of the spot, with those of any spots shift-clicked on
+        before it, and the starting frame. If event is None only the
+        shift-clicked spots are followed. It then removes both the the label
+        and threshold slider (since neither are needed for displaying the spot
+        track.) It then calls the Analysis function.'''
         if not self.Tracking:
+            seeds = list(self.seeds)
+            if event is not None:
+                seeds.append(self.display.To_frame(event.x, event.y))
+            if len(seeds) == 0:
+                return
             self.Tracking = 1
-            
-            self.starting_pos = (event.x, event.y)
+
+            self.Clear_markers()
+            self.starting_positions = seeds
+            self.starting_pos = seeds[0]
             self.start_frame = self.frame_num
 
             self.label.pack_forget()
             self.threshold_slider.pack_forget()
+            self.suggest_button.pack_forget()
             self.max_dist_slider.pack_forget()
             self.frame_slider.config(from_ = self.frame_num)
             self.File_menu()
@@ -259,97 +391,280 @@ class Spot_Track:
 
     def Close_window(self):
         '''Closes the Tkinter window.'''
+        if self.worker is not None:
+            self.worker.Cancel()
         self.root.destroy()
 
     #_____________Analysis______________#
 
     def Analysis(self):
-        '''Creates two lists, one containing the location of the spot from the
-        starting frame to three frames after it was last found in the window.
-        The other containing the frames with the spot drawn on them.'''
-
-        spot_found = True
-        i = self.start_frame
+        '''Starts following the spots on a worker thread, all in one pass
+        over the frames (see track_spots in BrownianCore). The spots are shown
+        on each frame as soon as they are found, and once every spot is lost
+        Analysis_done builds the lists of their locations.'''
         self.max_dist = self.max_distance.get()
-        j = 1
-        spot_loc = self.starting_pos
-
-        print 'Tracking Spot...'
-
-        while i < len(self.im_seq) and spot_found:
-            frame = self.im_seq[i]
-                
-            bbox = [int(spot_loc[0]+0.5) - self.max_dist*j, \
-                   int(spot_loc[1]+0.5) - self.max_dist*j, \
-                   int(spot_loc[0]+0.5) + self.max_dist*j, \
-                   int(spot_loc[1]+0.5) + self.max_dist*j]
-                
-            points = points_below_threshold(frame, self.threshold.get(), bbox)
-                
-            if points == []:
-                j += 1 
-                print 'Cannot find spot in frame %d' % i
-                if j == 4:
-                    spot_found = False
+        self.end_frame = self.start_frame
+        self.table = table_from_tracks([])
+        self.positions = [[] for seed in self.starting_positions]
+        self.position_frames = [[] for seed in self.starting_positions]
+        self.spot_markers = [self.Marker() for seed in self.starting_positions]
+        self.Start_worker(self.Analysis_done, track_spots, self.im_seq, \
+                          self.start_frame, self.starting_positions, \
+                          self.threshold.get(), self.max_dist, \
+                          self.localization, self.search, \
+                          writers = ('position_writer',))
+
+    def Analysis_done(self, tracks):
+        '''Keeps the locations of each spot in the frames it was found in,
+        from the starting frame until it was lost. self.track holds those of
+        the first spot.'''
+        if tracks is None:
+            tracks = [[] for seed in self.starting_positions]
+        self.positions = tracks
+        self.position_frames = [[i for (i, pos) in positions] \
+                                for positions in tracks]
+        self.tracks = [[(x, abs(y-self.im_size[0])) \
+                        for (i, (x, y)) in positions] for positions in tracks]
+        self.track = self.tracks[0]
+        self.table = table_from_tracks(tracks)
+
+        self.end_frame = max([positions[-1][0] for positions in tracks \
+                              if positions] + [self.start_frame])
+        self.frame_slider.config(to = self.end_frame)
+        self.Update_frame(None)
+
+    def Suggest_threshold(self):
+        '''Sweeps the thresholds over a sample of the frames on a worker
+        thread (see BrownianThreshold) and moves the threshold slider to the
+        one suggested.'''
+        self.Start_worker(self.Suggest_done, sweep_thresholds, self.im_seq, \
+                          writers = ())
+
+    def Suggest_done(self, sweep):
+        if sweep is not None and not self.Tracking:
+            threshold = sweep.Suggest()
+            #Frames of more than 8 bits can need a threshold above 255.
+            if threshold > float(self.threshold_slider.cget('to')):
+                self.threshold_slider.config(to = threshold)
+            self.threshold.set(threshold)
+            self.Show_progress('threshold sweep', None, None, \
+                               'Suggested threshold: %d' % self.threshold.get())
+
+    #_____________Worker Thread______________#
+
+    def Start_worker(self, done, function, *args, **kwargs):
+        '''Runs function(*args, **kwargs) on a Tracking_Worker (see
+        BrownianCore). The positions it finds are added to the lists of
+        self.positions, one for each spot, as they arrive and done(result) is
+        called when it finishes, or with what it had finished if it is
+        cancelled. A job already running is cancelled, without its results
+        being kept, and the new one is started once it has stopped.'''
+        self.next_job = (done, function, args, kwargs)
+        if self.worker is None:
+            self.Run_next_job()
+        else:
+            self.worker_done = None
+            self.worker.Cancel()
+
+    def Run_next_job(self):
+        '''Starts the job left by Start_worker.'''
+        done, function, args, kwargs = self.next_job
+        self.next_job = None
+        self.worker = Tracking_Worker(function, profile = self.profile, \
+                                      *args, **kwargs)
+        self.worker_done = done
+        self.Set_busy(True)
+        if self.poll_id is not None:
+            self.root.after_cancel(self.poll_id)
+        self.poll_id = self.root.after(POLL_INTERVAL, self.Poll_worker)
+
+    def Stop_worker(self, keep = True):
+        '''Cancels the running job, if any, and any waiting to start. The
+        window doesn't wait for it to stop; Poll_worker hands what it had
+        finished to its done function, unless keep is False.'''
+        self.next_job = None
+        if self.worker is not None:
+            self.worker.Cancel()
+            if not keep:
+                self.worker_done = None
+
+    def Set_busy(self, busy):
+        '''Disables the actions that would start another job, and so cancel
+        the one running, while there is one.'''
+        state = DISABLED if busy else NORMAL
+        self.suggest_button.config(state = state)
+        if self.Tracking:
+            for label in ('View All Tracks', 'Save All Tracks to File'):
+                self.filemenu.entryconfigure(label, state = state)
+
+    def Poll_worker(self):
+        '''Handles the messages sent back by the worker since the last call,
+        and calls itself again until the job is finished.'''
+        self.poll_id = None
+        if self.worker is None:
+            return
+
+        latest = None
+        finished = False
+        for (kind, value) in self.worker.Messages():
+            if self.worker_done is None:
+                #The results of a job being thrown away are ignored.
+                if kind in ('done', 'cancelled', 'error'):
+                    finished = True
+            elif kind == 'position':
+                latest, found = value
+                for (k, position) in found:
+                    self.positions[k].append((latest, position))
+                    self.position_frames[k].append(latest)
+            elif kind == 'progress':
+                self.Show_progress(*value)
+            elif kind == 'error':
+                self.Show_progress('error', None, None, value)
+                finished = True
             else:
-                spot_loc = cluster_center(points)
-                j = 1
-
-            (x, y) = (spot_loc[0], abs(spot_loc[1]-self.im_size[0]))
-            frame = draw_point(spot_loc, frame)
-
-            self.frames.append(frame)
-            self.track.append((x, y))
-
-            i += 1
-
-        print 'Done.'
-
-        self.end_frame = i-1
+                self.worker_done(value)
+                finished = True
+
+        if latest is not None and not finished:
+            self.frame_slider.config(to = latest)
+            self.Update_frame(None)
+
+        if finished:
+            self.worker = None
+            self.root.title('Spot Tracker')
+            if self.next_job is not None:
+                self.Run_next_job()
+            else:
+                self.Set_busy(False)
+        else:
+            self.poll_id = self.root.after(POLL_INTERVAL, self.Poll_worker)
 
-        self.frame_slider.config(to = self.end_frame)
-        self.Update_frame(self.start_frame)
+    def Show_progress(self, stage, done, total, message):
+        '''Shows how far the job has got in the title bar and passes the
+        progress on to the progress function.'''
+        if done is not None:
+            self.root.title('Spot Tracker - %s %d/%d' % (stage, done, total))
+        if self.progress is not None:
+            self.progress(stage, done, total, message)
 
     #_______________Some Useful methods____________#
 
     def Save_file(self):
-        '''Saves the x, y coordinates of the track to a tab delimated file.'''
-
-        filename = asksaveasfilename(filetypes = [('Text File','*.txt')],\
+        '''Saves the x, y coordinates of the track to a tab delimated file, or
+        to a track file or CSV file (see BrownianExport), chosen by the
+        extension of the file name. When several spots were followed, all of
+        their tracks are saved together; in a tab delimated file, one block
+        per spot.'''
+
+        filename = asksaveasfilename(filetypes = [('Text File','*.txt'),\
+                                                  ('Track File','*.trk'),\
+                                                  ('CSV File','*.csv')],\
                                      title="Save Track File As...",\
                                      master = self.root)
         
-        t = 0
         if len(filename) > 0:
             framerate = askstring('Enter Frame Rate',\
                                   'Time between frames:',\
                                   initialvalue = '0.1', \
                                   parent = self.root)
 
-        if len(filename) > 0 and framerate != None:
-            print framerate
+        if len(filename) > 0 and framerate != None and \
+           os.path.splitext(filename)[1].lower() in ('.trk', '.csv'):
+            export_tracks(self.table, filename, self.Metadata(framerate))
+
+        elif len(filename) > 0 and framerate != None:
             track_file = open(filename, 'w')
-            track_file.write('time(s)\tx pos\ty pos\n\n')
-            for pos in self.track[:-3]:
-                track_file.write('%.2f\t%.2f\t%.2f\n' % (t, pos[0],\
-                                abs(pos[1]-self.im_size[1])))
-                t += float(framerate)
+            for k, (positions, track) in enumerate(zip(self.positions, \
+                                                       self.tracks)):
+                if k > 0:
+                    track_file.write('\n')
+                if len(self.positions) > 1:
+                    track_file.write('spot %d\n' % (k + 1))
+                track_file.write('time(s)\tx pos\ty pos\n\n')
+                for ((i, loc), pos) in zip(positions, track):
+                    t = (i - self.start_frame)*float(framerate)
+                    track_file.write('%.2f\t%.2f\t%.2f\n' % (t, pos[0],\
+                                    abs(pos[1]-self.im_size[1])))
             track_file.close()
 
+    def Save_all_tracks(self):
+        '''Saves every track found by the multiple spot tracker to a track
+        file, see BrownianExport.'''
+        filename = asksaveasfilename(filetypes = [('Track File','*.trk'),\
+                                                  ('Text File','*.txt'),\
+                                                  ('CSV File','*.csv')],\
+                                     title="Save All Tracks As...",\
+                                     master = self.root)
+        if len(filename) == 0:
+            return
+        framerate = askstring('Enter Frame Rate', 'Time between frames:',\
+                              initialvalue = '0.1', parent = self.root)
+        if framerate == None:
+            return
+
+        def save(tracker):
+            if tracker is None:
+                return
+            self.all_tracks = tracker
+            export_tracks(tracker.table, filename, \
+                          self.Metadata(framerate, tracker.Parameters()))
+
+        if self.all_tracks == None:
+            self.Find_all_tracks(save)
+        else:
+            save(self.all_tracks)
+
+    def Metadata(self, framerate, parameters = None):
+        '''Returns the metadata saved with the tracks.'''
+        if parameters == None:
+            parameters = {'threshold': self.threshold.get(),
+                          'max_dist': self.max_distance.get(),
+                          'localization': self.localization,
+                          'search': self.search,
+                          'temporal_window': self.temporal_window,
+                          'local_radius': self.local_radius}
+        return {'source': self.filename,
+                'frame interval': float(framerate),
+                'frame size': list(self.im_size),
+                'parameters': parameters}
+
     def Save_frames(self):
         '''Saves the frames showing the spot location to the user selected
-        file and under the user selected name.'''
+        file and under the user selected name, as a multi-page Tiff, an
+        animated Gif or numbered images (see BrownianMovie).'''
         directory = asksaveasfilename(master = self.root,\
+                                      filetypes = [('Tiff','*.tif'),\
+                                                   ('GIF','*.gif'),\
+                                                   ('JPEG images','*.jpg')],\
                                       title="Save Track Images To...")
         if len(directory) > 0:
-            i = 1
-            for frame in self.frames[:-3]:
-                frame.save(directory +'_' + str(i) + '.jpg')
-                i += 1
+            if os.path.splitext(directory)[1] == '':
+                directory += '.jpg'
+            points = {}
+            for positions in self.positions:
+                for (i, pos) in positions:
+                    points.setdefault(i, []).append(pos)
+            #Frames in which every spot was missed are saved too, so that
+            #the images are numbered by frame.
+            save_movie((draw_points(points.get(i, []), self.im_seq[i]) \
+                        for i in xrange(self.start_frame, \
+                                        self.end_frame + 1)), directory)
             
+    def Save_profile(self):
+        '''Saves the time taken by each stage of the tracking, and the counts
+        kept with it, to a JSON file (see BrownianProfile).'''
+        filename = asksaveasfilename(filetypes = [('JSON File','*.json')],\
+                                     title="Save Timing Report As...",\
+                                     master = self.root)
+        if len(filename) > 0:
+            self.profile.Save(filename)
+
     def Plot(self):
         '''Launches a pylab plot of the position of the spot in each frame.'''
-        Plot_track(self.track)
+        #Spots that were never found have empty tracks.
+        tracks = [track for track in self.tracks if track]
+        if tracks:
+            Plot_track(tracks[0], tracks[1:])
 
 if "__main__" == __name__:
 
@@ -0,0 +1,201 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the analysis of the spot
+tracks: mean squared displacement (MSD), displacement histograms and fits of
+the diffusion coefficient.
+
+Each function takes the tracks either as a Track_Table (MST.table or
+Spot_Track.table) or as a list of tracks in the form of MST.tracks. Frames in
+which a spot was not found are gaps: displacements are only taken between two
+frames in which the spot was found.
+
+For a spot diffusing in two dimensions with diffusion coefficient D,
+MSD(t) = 4*D*t + offset, where the offset comes from the error in locating
+the spot.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from numpy import zeros, arange, asarray, nan, isnan, sqrt, \
+     conj, histogram, concatenate, errstate, nansum, where
+from numpy.fft import rfft, irfft
+from BrownianTracks import Track_Table, table_from_tracks
+
+def as_table(tracks):
+    '''Returns the tracks as a Track_Table.'''
+    if isinstance(tracks, Track_Table):
+        return tracks
+    return table_from_tracks(list(tracks))
+
+def track_series(table, k):
+    '''Returns (x, y, found) for the k-th track of the table as arrays with
+    one entry per frame from the first to the last frame of the track. 'found'
+    is False in the gaps, where x and y are 0.'''
+    track = table.Track(k)
+    frames = track['frame'] - track['frame'][0]
+    n = frames[-1] + 1 if len(frames) else 0
+
+    x, y, found = zeros(n), zeros(n), zeros(n, dtype = bool)
+    x[frames], y[frames], found[frames] = track['x'], track['y'], True
+
+    return x, y, found
+
+def correlate(a, b):
+    '''Returns c[m] = sum over t of a[t]*b[t+m] for m from 0 to len(a)-1,
+    computed with FFTs.'''
+    n = len(a)
+    size = 1
+    while size < 2*n:
+        size *= 2
+    return irfft(conj(rfft(a, size))*rfft(b, size), size)[:n]
+
+def track_msd(x, y, found):
+    '''Returns (sums, counts) for one track: sums[m] is the sum of the squared
+    displacements over all pairs of frames m apart in which the spot was found,
+    and counts[m] is the number of such pairs. MSD = sums/counts. Uses FFTs, so
+    takes time in proportion to N log N for a track of N frames.'''
+    w = found.astype(float)
+    counts = correlate(w, w).round()
+
+    sums = zeros(len(x))
+    for r in (x*w, y*w):
+        r2 = r*r
+        sums += correlate(w, r2) + correlate(r2, w) - 2*correlate(r, r)
+
+    return sums.clip(0), counts.astype(int)
+
+def time_averaged_msd(tracks, max_lag = None):
+    '''Returns (lags, msd, counts) where msd[k, m] is the time averaged MSD
+    of track k at a lag of lags[m] frames and counts[k, m] the number of
+    displacements it is averaged over. msd is nan where there are none.'''
+    table = as_table(tracks)
+    series = [track_series(table, k) for k in xrange(len(table))]
+    n = max([len(s[0]) for s in series] or [0])
+    if max_lag is None or max_lag >= n:
+        max_lag = max(n-1, 0)
+
+    sums = zeros((len(table), max_lag+1))
+    counts = zeros((len(table), max_lag+1), dtype = int)
+    for k, (x, y, found) in enumerate(series):
+        s, c = track_msd(x, y, found)
+        m = min(len(s), max_lag+1)
+        sums[k, :m], counts[k, :m] = s[:m], c[:m]
+
+    with errstate(invalid = 'ignore', divide = 'ignore'):
+        msd = where(counts > 0, sums/counts, nan)
+
+    return arange(max_lag+1), msd, counts
+
+def pooled_msd(tracks, max_lag = None):
+    '''Returns (lags, msd, counts), the time averaged MSD pooled over all of
+    the tracks, each displacement counting equally.'''
+    lags, msd, counts = time_averaged_msd(tracks, max_lag)
+    total = counts.sum(0)
+    with errstate(invalid = 'ignore', divide = 'ignore'):
+        pooled = where(total > 0, nansum(msd*counts, 0)/total, nan)
+    return lags, pooled, total
+
+def ensemble_msd(tracks, max_lag = None):
+    '''Returns (lags, msd, counts) where msd[m] is the squared displacement
+    from the start of each track after lags[m] frames, averaged over the
+    tracks found at that time.'''
+    table = as_table(tracks)
+    series = [track_series(table, k) for k in xrange(len(table))]
+    n = max([len(s[0]) for s in series] or [0])
+    if max_lag is None or max_lag >= n:
+        max_lag = max(n-1, 0)
+
+    sums = zeros(max_lag+1)
+    counts = zeros(max_lag+1, dtype = int)
+    for (x, y, found) in series:
+        m = min(len(x), max_lag+1)
+        d2 = (x[:m]-x[0])**2 + (y[:m]-y[0])**2
+        sums[:m] += d2*found[:m]
+        counts[:m] += found[:m]
+
+    with errstate(invalid = 'ignore', divide = 'ignore'):
+        msd = where(counts > 0, sums/counts, nan)
+
+    return arange(max_lag+1), msd, counts
+
+def displacements(tracks, lag = 1):
+    '''Returns (dx, dy), arrays of every displacement over 'lag' frames between
+    two frames in which the spot was found.'''
+    table = as_table(tracks)
+    dx, dy = [], []
+    for k in xrange(len(table)):
+        x, y, found = track_series(table, k)
+        both = found[lag:] & found[:-lag] if lag < len(x) else zeros(0, bool)
+        dx.append((x[lag:]-x[:-lag])[both])
+        dy.append((y[lag:]-y[:-lag])[both])
+
+    if not dx:
+        return zeros(0), zeros(0)
+    return concatenate(dx), concatenate(dy)
+
+def displacement_histogram(tracks, lag = 1, bins = 50):
+    '''Returns (counts, edges) of the histogram of the x and y displacements
+    over 'lag' frames, taken together. For free diffusion this is a Gaussian
+    with variance 2*D*lag.'''
+    dx, dy = displacements(tracks, lag)
+    return histogram(concatenate((dx, dy)), bins = bins)
+
+def fit_diffusion(lags, msd, counts, dt = 1.0, pixel_size = 1.0, \
+                  dimensions = 2, max_lag = None):
+    '''Fits MSD = 2*dimensions*D*t + offset to the MSD curve by weighted least
+    squares, each lag weighted by the number of displacements it is averaged
+    over. Lag 0 is left out, as are lags above max_lag (by default a quarter
+    of the longest lag). dt is the time between frames and pixel_size the
+    length of a pixel, which give the units of D. Returns (D, D_error,
+    offset); D is nan if there are too few points to fit.'''
+    lags, msd, counts = asarray(lags), asarray(msd), asarray(counts)
+    if max_lag is None:
+        max_lag = max(len(lags)/4, 2)
+
+    use = (lags > 0) & (lags <= max_lag) & ~isnan(msd) & (counts > 0)
+    t = lags[use]*dt
+    m = msd[use]*pixel_size**2
+    w = counts[use].astype(float)
+    if len(t) < 2:
+        return nan, nan, nan
+
+    #Weighted least squares for m = a*t + b.
+    W, Wt, Wtt = w.sum(), (w*t).sum(), (w*t*t).sum()
+    Wm, Wtm = (w*m).sum(), (w*t*m).sum()
+    det = W*Wtt - Wt*Wt
+    a = (W*Wtm - Wt*Wm)/det
+    b = (Wtt*Wm - Wt*Wtm)/det
+
+    if len(t) > 2:
+        residual = (w*(m - a*t - b)**2).sum()/(len(t)-2)
+        a_error = sqrt(residual*W/det)
+    else:
+        a_error = nan
+
+    return a/(2*dimensions), a_error/(2*dimensions), b
+
+def diffusion_coefficients(tracks, dt = 1.0, pixel_size = 1.0, \
+                           dimensions = 2, max_lag = None):
+    '''Fits the diffusion coefficient of each track from its time averaged
+    MSD. Returns arrays (D, D_error), with one entry per track. By default
+    each track is fitted up to a quarter of its own length.'''
+    table = as_table(tracks)
+    lags, msd, counts = time_averaged_msd(table)
+    lengths = table.Lengths()
+    D, error = zeros(len(msd)), zeros(len(msd))
+    for k in xrange(len(msd)):
+        if max_lag is None:
+            track_lag = max(lengths[k]/4, 2)
+        else:
+            track_lag = max_lag
+        D[k], error[k], offset = fit_diffusion(lags, msd[k], counts[k], dt, \
+                                    pixel_size, dimensions, track_lag)
+    return D, error
+
+def diffusion_coefficient(tracks, dt = 1.0, pixel_size = 1.0, \
+                          dimensions = 2, max_lag = None):
+    '''Fits one diffusion coefficient to the MSD pooled over all of the
+    tracks. Returns (D, D_error, offset).'''
+    lags, msd, counts = pooled_msd(tracks)
+    return fit_diffusion(lags, msd, counts, dt, pixel_size, dimensions, \
+                         max_lag)
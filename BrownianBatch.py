@@ -0,0 +1,296 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file runs the multiple spot tracker
+over many image sequences from the command line, without opening any windows,
+spreading the files over all of the processors of the machine. For example:
+
+    python BrownianBatch.py --threshold 100 --max-dist 30 data/*.tif
+
+writes the tracks found in data/name.tif to data/name_tracks.txt. With
+--format trk the tracks are written to the binary track files of
+BrownianExport instead, which are much faster to write and read. With
+--movie the frames with the tracks drawn on them are also written to
+data/name_tracks.tif, and with --profile the time taken by each stage is
+written to data/name_profile.json. With --threshold auto the threshold is
+chosen for each file by the threshold sweep of BrownianThreshold. With
+--time-chunk the files are tracked one at a time instead, each split into
+chunks of frames that are tracked on all of the processors at once, which
+suits a few very long sequences.
+
+A file that can't be tracked is reported and the rest are tracked anyway;
+the exit status is 1 if any file failed.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import sys
+import os.path
+import traceback
+from glob import glob
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
+from MultipleBeadBrownian import Multiple_Spot_Track, stream_tracks
+from BrownianFrames import open_frames
+from BrownianCache import Detection_Cache
+from BrownianExport import track_writer
+from BrownianMovie import Movie_Writer
+from BrownianProfile import Profile
+from BrownianPreprocess import preprocess
+from BrownianThreshold import Threshold_Sweep
+
+#Number of streamed tracks collected before they are written.
+STREAM_TRACKS = 1000
+
+def track_filename(filename, output_dir = None, extension = 'txt'):
+    '''Returns the name of the track file written for the given sequence.'''
+    name = os.path.splitext(filename)[0] + '_tracks.' + extension
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
+
+def profile_filename(filename, output_dir = None):
+    '''Returns the name of the timing report written for the given
+    sequence.'''
+    name = os.path.splitext(filename)[0] + '_profile.json'
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
+
+def threshold_value(text):
+    '''Reads the --threshold option: a whole number, or 'auto'.'''
+    if text == 'auto':
+        return text
+    return int(text)
+
+def choose_threshold(frames, parameters, profile = None):
+    '''Returns the parameters with the threshold 'auto' replaced by the one
+    the threshold sweep suggests for the frame source, after the background
+    corrections in the parameters.'''
+    if parameters['threshold'] != 'auto':
+        return parameters
+    corrected = preprocess(frames, parameters.get('temporal_window', 0), \
+                           parameters.get('local_radius', 0))
+    sweep = Threshold_Sweep(corrected, \
+                            start_frame = parameters.get('start_frame', 0), \
+                            end_frame = parameters.get('end_frame'), \
+                            profile = profile)
+    return dict(parameters, threshold = sweep.Suggest())
+
+def save_tracks(tracks, filename, metadata = None):
+    '''Saves each track, as in Multiple_Spot_Track.tracks, to a track file in
+    the format given by its extension (see BrownianExport). 'tracks' may be
+    any iterable, including the generator returned by stream_tracks, in which
+    case the tracks are appended to the file in groups as they arrive.
+    Returns the number of tracks written.'''
+    writer = track_writer(filename, metadata)
+    k = 0
+    group = []
+    for track in tracks:
+        group.append(track)
+        k += 1
+        if len(group) == STREAM_TRACKS:
+            writer.Write_tracks(group)
+            group = []
+    writer.Write_tracks(group)
+    writer.Close()
+    return k
+
+def track_stack(job):
+    '''Tracks the spots in one image sequence and saves them. 'job' is a tuple
+    (filename, output filename, parameters, stream, cache directory, frame
+    rate, movie filename, profile filename) where parameters is a dictionary
+    of keyword arguments for Multiple_Spot_Track. If stream is True the tracks
+    are found with stream_tracks and written as they end. If a cache
+    directory is given, the spots found are kept there for later runs. If a
+    movie filename is given, the frames with the tracks drawn on them are
+    written to it, and if a profile filename is given the timing report is.
+    Returns (filename, number of tracks, None), or (filename, None, error) if
+    the file could not be tracked, where error is the traceback, so that one
+    bad file doesn't stop the batch.'''
+    filename, output, parameters, stream, cache_dir, frame_rate, movie, \
+              profile_file = job
+    try:
+        return filename, save_stack_tracks(filename, output, parameters, \
+                                           stream, cache_dir, frame_rate, \
+                                           movie, profile_file), None
+    except Exception:
+        return filename, None, traceback.format_exc()
+
+def save_stack_tracks(filename, output, parameters, stream, cache_dir, \
+                      frame_rate, movie, profile_file):
+    '''Does the work of track_stack, returning the number of tracks.'''
+    profile = Profile()
+
+    cache = None
+    if cache_dir is not None:
+        cache = Detection_Cache(cache_dir)
+
+    frames = open_frames(filename)
+    parameters = choose_threshold(frames, parameters, profile)
+
+    if stream:
+        metadata = {'parameters': parameters,
+                    'frame interval': frame_rate,
+                    'frame size': list(frames[0].size),
+                    'source': filename}
+        writer = None
+        if movie is not None:
+            writer = Movie_Writer(movie)
+        tracks = stream_tracks(frames, cache = cache, frame_writer = writer, \
+                               profile = profile, **parameters)
+        n = save_tracks(tracks, output, metadata)
+        if writer is not None:
+            writer.Close()
+    else:
+        tracker = Multiple_Spot_Track(im_seq = frames, \
+                                      cache = cache, profile = profile, \
+                                      **parameters)
+        if movie is not None:
+            tracker.Save_movie(movie)
+        n = tracker.Save_tracks(output, frame_rate, filename)
+
+    if profile_file is not None:
+        profile.Save(profile_file)
+    return n
+
+def find_stacks(patterns):
+    '''Returns the files matching each of the names or glob patterns given,
+    in order and without repeats.'''
+    filenames = []
+    for pattern in patterns:
+        for filename in sorted(glob(pattern)) or [pattern]:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+def run_batch(filenames, parameters, output_dir = None, processes = None, \
+              stream = False, cache_dir = None, extension = 'txt', \
+              frame_rate = None, movie = False, profile = False):
+    '''Tracks every file in 'filenames' using a pool of 'processes' worker
+    processes (one per processor by default) and returns a list of (filename,
+    number of tracks, error) in the order the files were given, as
+    track_stack returns them. The tracks are saved
+    in the format given by 'extension', one of 'txt', 'csv' or 'trk'. If
+    movie is True a multi-page Tiff of the tracks is also written, and if
+    profile is True a JSON timing report. output_dir is made if it doesn't
+    exist.'''
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = [(filename, track_filename(filename, output_dir, extension), \
+             parameters, stream, cache_dir, frame_rate, \
+             track_filename(filename, output_dir, 'tif') if movie else None, \
+             profile_filename(filename, output_dir) if profile else None) \
+            for filename in filenames]
+
+    if processes == 1:
+        return map(track_stack, jobs)
+
+    pool = Pool(processes or cpu_count())
+    try:
+        return pool.map(track_stack, jobs, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv = None):
+    parser = ArgumentParser(description = 'Tracks the spots in each of the '
+                            'given Tiff or Gif files and saves the tracks '
+                            'next to them as name_tracks.txt (or .csv, .trk).')
+    parser.add_argument('stacks', nargs = '+',
+                        help = 'image sequence files or glob patterns')
+    parser.add_argument('--threshold', type = threshold_value, default = 128,
+                        help = 'pixels below this value are part of a spot, '
+                        'or auto to choose it for each file')
+    parser.add_argument('--max-dist', type = int, default = 40,
+                        help = 'largest distance a spot may move between '
+                        'frames')
+    parser.add_argument('--max-frames', type = int, default = 3,
+                        help = 'largest number of frames a spot may go '
+                        'missing for')
+    parser.add_argument('--linking', choices = ['nearest', 'optimal'],
+                        default = 'nearest',
+                        help = 'how spots are joined to tracks')
+    parser.add_argument('--localization', default = 'centroid',
+                        choices = ['centroid', 'weighted', 'gaussian'],
+                        help = 'how the center of each spot is found')
+    parser.add_argument('--background-window', type = int, default = 0,
+                        help = 'number of frames averaged for the background '
+                        'subtracted from each frame (0 for none)')
+    parser.add_argument('--local-radius', type = int, default = 0,
+                        help = 'half width of the square averaged for the '
+                        'local background of each pixel (0 for none)')
+    parser.add_argument('--start-frame', type = int, default = 0)
+    parser.add_argument('--end-frame', type = int, default = None)
+    parser.add_argument('--processes', type = int, default = None,
+                        help = 'number of worker processes (default: one per '
+                        'processor)')
+    parser.add_argument('--time-chunk', type = int, default = None,
+                        help = 'track each file in chunks of this many '
+                        'frames, using all of the worker processes for one '
+                        'file at a time')
+    parser.add_argument('--stream', action = 'store_true',
+                        help = 'write tracks as they end, keeping only the '
+                        'live tracks in memory')
+    parser.add_argument('--cache-dir', default = None,
+                        help = 'directory in which to keep the spots found, '
+                        'so reruns with other linking settings are quick')
+    parser.add_argument('--format', choices = ['txt', 'csv', 'trk'],
+                        default = 'txt',
+                        help = 'format of the track files: tab delimited '
+                        'text, comma separated text or binary track files')
+    parser.add_argument('--frame-rate', type = float, default = None,
+                        help = 'time between frames, saved with the tracks')
+    parser.add_argument('--movie', action = 'store_true',
+                        help = 'also write the frames with the tracks drawn '
+                        'on them to name_tracks.tif')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'also write the time taken by each stage, and '
+                        'counts such as the blobs found, to name_profile.json')
+    parser.add_argument('--output-dir', default = None,
+                        help = 'directory for the track files (default: next '
+                        'to each stack)')
+    args = parser.parse_args(argv)
+    if args.stream and args.time_chunk:
+        parser.error('--stream and --time-chunk cannot be used together')
+
+    parameters = {'threshold': args.threshold,
+                  'max_dist': args.max_dist,
+                  'max_frames': args.max_frames,
+                  'linking': args.linking,
+                  'localization': args.localization,
+                  'temporal_window': args.background_window,
+                  'local_radius': args.local_radius,
+                  'start_frame': args.start_frame,
+                  'end_frame': args.end_frame}
+    processes = args.processes
+    if args.time_chunk:
+        parameters['time_chunk'] = args.time_chunk
+        parameters['processes'] = processes
+        processes = 1
+
+    filenames = find_stacks(args.stacks)
+    print 'Tracking %d files...' % len(filenames)
+    failed = []
+    for filename, n, error in run_batch(filenames, parameters,
+                                        args.output_dir, processes,
+                                        args.stream, args.cache_dir,
+                                        args.format, args.frame_rate,
+                                        args.movie, args.profile):
+        if error is None:
+            print '%s: %d tracks' % (filename, n)
+        else:
+            print '%s: failed' % filename
+            print >> sys.stderr, '%s:\n%s' % (filename, error)
+            failed.append(filename)
+    if failed:
+        print 'Done, but %d of %d files failed:' % (len(failed), \
+                                                     len(filenames))
+        for filename in failed:
+            print '    %s' % filename
+        sys.exit(1)
+    print 'Done.'
+
+if "__main__" == __name__:
+
+    main()
@@ -0,0 +1,241 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains a generator of synthetic
+image sequences of diffusing beads, with known tracks, and a benchmark of the
+detection, linking and drawing steps of the trackers run on them. For example:
+
+    python BrownianBenchmark.py --beads 200 --frames 100 --size 512
+
+reports the speed of each step, the peak memory used and how well the tracks
+found match the true ones.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import resource
+from time import time
+from argparse import ArgumentParser
+from numpy import arange, exp, zeros, sqrt, repeat, nan, ogrid, uint8, \
+     concatenate
+from numpy.random import RandomState
+from scipy.spatial import cKDTree
+from PIL import Image
+from MultipleBeadBrownian import Multiple_Spot_Track, Track_Renderer, \
+     threshold2, group_points, center_of_clusters, find_blobs, draw_chain
+from BrownianSearch import points_below_threshold, window_center
+from BrownianTracks import Track_Table
+
+def synthetic_stack(beads = 50, frames = 100, size = (256, 256), D = 1.0, \
+                    psf_width = 1.5, depth = 150, background = 220, \
+                    noise = 8.0, blinking = 0.0, seed = 0):
+    '''Returns (frames, truth): a list of 2D uint8 arrays showing dark beads
+    diffusing on a bright background, and a Track_Table of their true
+    positions. Each bead takes a Gaussian step each frame, with variance 2*D
+    pixels squared in x and in y, and is drawn as a Gaussian spot of standard
+    deviation psf_width pixels, 'depth' levels darker than the background.
+    Gaussian noise of standard deviation 'noise' is added, and each bead is
+    missing from a frame with probability 'blinking'. Beads that drift out of
+    the frame reappear on the other side as new tracks.'''
+    random = RandomState(seed)
+    width, height = size
+
+    position = random.uniform((0, 0), (width, height), (beads, 2))
+    track_id = arange(beads)
+    next_id = beads
+
+    ids, numbers, xs, ys = [], [], [], []
+    stack = []
+    radius = int(3*psf_width + 1)
+    for i in xrange(frames):
+        if i > 0:
+            position += random.normal(0, sqrt(2*D), (beads, 2))
+            outside = (position < 0).any(1) | (position[:, 0] >= width) | \
+                      (position[:, 1] >= height)
+            position[:, 0] %= width
+            position[:, 1] %= height
+            track_id[outside] = arange(next_id, next_id + outside.sum())
+            next_id += outside.sum()
+
+        image = zeros((height, width))
+        shown = random.rand(beads) >= blinking
+        for (x, y) in position[shown]:
+            x0, y0 = max(int(x) - radius, 0), max(int(y) - radius, 0)
+            x1, y1 = min(int(x) + radius + 1, width), \
+                     min(int(y) + radius + 1, height)
+            yy, xx = ogrid[y0:y1, x0:x1]
+            image[y0:y1, x0:x1] += exp(-((xx-x)**2 + (yy-y)**2) / \
+                                       (2.0*psf_width**2))
+
+        image = background - depth*image.clip(0, 1) + \
+                random.normal(0, noise, image.shape)
+        stack.append(image.clip(0, 255).astype(uint8))
+
+        ids.append(track_id[shown].copy())
+        numbers.append(repeat(i, shown.sum()))
+        xs.append(position[shown, 0].copy())
+        ys.append(position[shown, 1].copy())
+
+    truth = Track_Table(concatenate(ids), concatenate(numbers),
+                        concatenate(xs), concatenate(ys))
+    return stack, truth
+
+def peak_memory():
+    '''Returns the largest amount of memory this process has used so far, in
+    MB (as reported by the operating system, so it never goes down).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def timed(function, *args, **kwargs):
+    '''Calls the function and returns (result, seconds taken).'''
+    start = time()
+    result = function(*args, **kwargs)
+    return result, time() - start
+
+def match_accuracy(table, truth, radius = 2.0):
+    '''Compares the tracks found to the true tracks. Each position found is
+    matched to the nearest true position in the same frame within 'radius'
+    pixels. Returns a dictionary of:
+
+    recall :        fraction of true positions that were found.
+    precision :     fraction of positions found that match a true one.
+    error :         mean distance from a matched position to the true one.
+    link accuracy : fraction of the links between consecutive positions of a
+                    track found that join two positions of the same bead.'''
+    matched_id = zeros(table.Size(), dtype = int) - 1
+    errors = []
+    for i in set(truth.frame.tolist()):
+        true_rows = (truth.frame == i).nonzero()[0]
+        rows = (table.frame == i).nonzero()[0]
+        if len(rows) == 0:
+            continue
+        tree = cKDTree(zip(truth.x[true_rows], truth.y[true_rows]))
+        d, nearest = tree.query(zip(table.x[rows], table.y[rows]),
+                                distance_upper_bound = radius)
+        found = d <= radius
+        matched_id[rows[found]] = truth.track_id[true_rows[nearest[found]]]
+        errors.extend(d[found].tolist())
+
+    matched = matched_id >= 0
+    links = zeros(table.Size(), dtype = bool)
+    links[1:] = table.track_id[1:] == table.track_id[:-1]
+    good = links[1:] & matched[1:] & (matched_id[1:] == matched_id[:-1])
+
+    return {'recall': len(errors) / float(max(truth.Size(), 1)),
+            'precision': matched.sum() / float(max(table.Size(), 1)),
+            'error': sum(errors) / len(errors) if errors else nan,
+            'link accuracy': good.sum() / float(max(links.sum(), 1))}
+
+def run_benchmark(beads = 50, frames = 100, size = (256, 256), D = 1.0, \
+                  threshold = 128, max_dist = 10, max_frames = 3, \
+                  blinking = 0.0, noise = 8.0, seed = 0, processes = 1, \
+                  slow_frames = 2, time_chunk = None):
+    '''Generates a synthetic sequence and times each step of the trackers on
+    it. The slower functions that work on lists of points (threshold2,
+    group_points and draw_chain) are only timed on the first slow_frames
+    frames. If time_chunk is given, the tracker is also timed tracking chunks
+    of that many frames at once, and checked against the one pass tracks.
+    Returns the results as a dictionary.'''
+    report = {}
+    (stack, truth), seconds = timed(synthetic_stack, beads, frames, size, D,
+                                    blinking = blinking, noise = noise,
+                                    seed = seed)
+    report['generate s'] = seconds
+
+    images = [Image.fromarray(frame) for frame in stack]
+
+    #Detection of all spots in a frame.
+    spots, seconds = timed(lambda: [find_blobs(frame, threshold)[0]
+                                    for frame in stack])
+    detections = sum(len(s) for s in spots)
+    report['find_blobs frames/s'] = frames / seconds
+    report['find_blobs detections/s'] = detections / seconds
+
+    def slow_detection():
+        for image in images[:slow_frames]:
+            center_of_clusters(group_points(threshold2(image, threshold)))
+    n = min(slow_frames, frames)
+    if n > 0:
+        result, seconds = timed(slow_detection)
+        report['threshold2+group_points frames/s'] = n / seconds
+
+    #The multiple spot tracker: detection, then linking.
+    tracker, seconds = timed(Multiple_Spot_Track, max_frames = max_frames,
+                             max_dist = max_dist, threshold = threshold,
+                             im_seq = stack, processes = processes)
+    report['Multiple_Spot_Track frames/s'] = frames / seconds
+
+    tracker.tracks = []
+    result, seconds = timed(tracker.Track_spots)
+    tracker.Eliminate_short_tracks()
+    report['Track_spots frames/s'] = frames / seconds
+    report['tracks'] = len(tracker.table)
+    report.update(match_accuracy(tracker.table, truth))
+
+    if time_chunk:
+        chunked, seconds = timed(Multiple_Spot_Track, max_frames = max_frames,
+                                 max_dist = max_dist, threshold = threshold,
+                                 im_seq = stack, processes = processes,
+                                 time_chunk = time_chunk)
+        report['time chunked frames/s'] = frames / seconds
+        report['time chunked matches'] = float(
+            list(chunked.tracks) == list(tracker.tracks))
+
+    #The single spot search window, around each true position in frame 0.
+    first = truth.Frames(0, 1)
+    boxes = [[int(x) - 3*max_dist, int(y) - 3*max_dist, int(x) + 3*max_dist,
+              int(y) + 3*max_dist] for x, y in zip(first.x, first.y)]
+    if boxes:
+        result, seconds = timed(lambda: [window_center(stack[0], threshold, b)
+                                         for b in boxes])
+        report['window_center windows/s'] = len(boxes) / seconds
+        result, seconds = timed(lambda: [points_below_threshold(images[0],
+                                         threshold, b) for b in boxes])
+        report['points_below_threshold windows/s'] = len(boxes) / seconds
+
+    #Drawing the tracks.
+    renderer = Track_Renderer(tracker.table, size)
+    result, seconds = timed(lambda: [renderer.Render(images[i], i)
+                                     for i in xrange(frames)])
+    report['Track_Renderer frames/s'] = frames / seconds
+    if n > 0:
+        paths = list(tracker.tracks)
+        result, seconds = timed(lambda: [draw_chain(paths, images[i], i)
+                                         for i in xrange(n)])
+        report['draw_chain frames/s'] = n / seconds
+
+    report['peak memory MB'] = peak_memory()
+    return report
+
+def main(argv = None):
+    parser = ArgumentParser(description = 'Benchmarks the spot trackers on '
+                            'a synthetic sequence of diffusing beads.')
+    parser.add_argument('--beads', type = int, default = 50)
+    parser.add_argument('--frames', type = int, default = 100)
+    parser.add_argument('--size', type = int, default = 256,
+                        help = 'width and height of the frames in pixels')
+    parser.add_argument('--D', type = float, default = 1.0,
+                        help = 'diffusion coefficient in pixels^2/frame')
+    parser.add_argument('--blinking', type = float, default = 0.0,
+                        help = 'chance of a bead missing from a frame')
+    parser.add_argument('--noise', type = float, default = 8.0)
+    parser.add_argument('--threshold', type = int, default = 128)
+    parser.add_argument('--max-dist', type = int, default = 10)
+    parser.add_argument('--max-frames', type = int, default = 3)
+    parser.add_argument('--processes', type = int, default = 1)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--time-chunk', type = int, default = None,
+                        help = 'also time tracking in chunks of this many '
+                        'frames')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.beads, args.frames, (args.size, args.size),
+                           args.D, args.threshold, args.max_dist,
+                           args.max_frames, args.blinking, args.noise,
+                           args.seed, args.processes,
+                           time_chunk = args.time_chunk)
+
+    for name in sorted(report):
+        print '%-40s %12.4g' % (name, report[name])
+
+if "__main__" == __name__:
+
+    main()
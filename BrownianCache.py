@@ -0,0 +1,131 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the cache of the spots
+found in each frame, used by the multiple spot tracker so that the same frames
+are never searched twice with the same settings.
+
+Each entry is keyed by the contents of the frame (see
+Frame_Sequence.Frame_key) and the settings used to find the spots (the
+threshold and the localization method). The linking settings, max_dist and
+max_frames, are not part of the key, so changing only those reuses every
+entry. Entries are kept in memory and, if a directory is given, on disk, where
+they are shared between runs and between processes.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import os
+import os.path
+import cPickle
+from hashlib import sha1
+from tempfile import mkstemp
+from threading import Lock
+from BrownianFrames import Lru_cache
+
+#Default bounds on the number of frames kept in memory and the size of the
+#cache directory in bytes.
+MEMORY_ITEMS = 10000
+DISK_BYTES = 1 << 30
+
+class Detection_Cache:
+    def __init__(self, directory = None, memory_items = MEMORY_ITEMS, \
+                 disk_bytes = DISK_BYTES):
+        '''Creates a cache holding the spots of at most memory_items frames in
+        memory and, if 'directory' is given, at most disk_bytes bytes of them
+        on disk. When either is full the least recently used entries are
+        removed.'''
+        self.memory = Lru_cache(memory_items)
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.disk_used = sum(os.path.getsize(path) for path in \
+                                 self.Entries())
+
+    def Key(self, frame_key, settings):
+        '''Returns the name of the entry for the frame and settings.'''
+        return sha1(repr((frame_key, settings))).hexdigest()
+
+    def Entries(self):
+        '''Returns the paths of the entries in the cache directory.'''
+        return [os.path.join(self.directory, name) for name in \
+                os.listdir(self.directory) if name.endswith('.spots')]
+
+    def Get(self, frame_key, settings):
+        '''Returns the spots stored for the frame and settings, or None.'''
+        key = self.Key(frame_key, settings)
+        spots = self.memory.Get(key)
+
+        if spots is None and self.directory is not None:
+            path = os.path.join(self.directory, key + '.spots')
+            try:
+                spots = cPickle.load(open(path, 'rb'))
+                #Mark the entry as recently used.
+                os.utime(path, None)
+                self.memory.Put(key, spots)
+            except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+                spots = None
+
+        if spots is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return spots
+
+    def Put(self, frame_key, settings, spots):
+        '''Stores the spots found in the frame with the given settings.'''
+        key = self.Key(frame_key, settings)
+        self.memory.Put(key, spots)
+
+        if self.directory is None:
+            return
+
+        #Written to a temporary file first so other processes never read a
+        #half written entry.
+        handle, temporary = mkstemp(dir = self.directory)
+        data = os.fdopen(handle, 'wb')
+        cPickle.dump(spots, data, cPickle.HIGHEST_PROTOCOL)
+        data.close()
+        path = os.path.join(self.directory, key + '.spots')
+        os.rename(temporary, path)
+
+        with self.lock:
+            self.disk_used += os.path.getsize(path)
+            if self.disk_used > self.disk_bytes:
+                self.Evict()
+
+    def Evict(self):
+        '''Removes the least recently used entries from the cache directory
+        until it is below three quarters of its size limit.'''
+        entries = []
+        for path in self.Entries():
+            try:
+                entries.append((os.path.getmtime(path), \
+                                os.path.getsize(path), path))
+            except OSError:
+                pass
+        entries.sort()
+
+        self.disk_used = sum(size for (time, size, path) in entries)
+        for (time, size, path) in entries:
+            if self.disk_used <= 3*self.disk_bytes/4:
+                break
+            try:
+                os.remove(path)
+                self.disk_used -= size
+            except OSError:
+                pass
+
+    def Clear(self):
+        '''Removes every entry, in memory and on disk.'''
+        self.memory.Clear()
+        if self.directory is not None:
+            for path in self.Entries():
+                os.remove(path)
+            self.disk_used = 0
@@ -0,0 +1,252 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the tracking done by the
+Spot Tracker window (see Brownian), without the window, and the worker thread
+that the window runs it on so that it stays responsive.
+
+track_spot follows one spot, track_spots follows several chosen spots in
+one pass over the frames, and track_all_spots runs the multiple spot
+tracker. All may be used from any script. Each takes a frame_writer, called
+as frame_writer(index, image) with every frame as soon as it is drawn, and a
+Profile (see BrownianProfile) whose progress function is told how far they
+have got. track_spot also takes a position_writer, called as
+position_writer(index, (x, y)) with each position found, and track_spots
+one called as position_writer(index, [(spot, (x, y)), ...]) with the
+positions of the spots found in each frame, numbered from 0 in the order they
+were given.
+
+Tracking_Worker runs either of them on a thread. Everything that comes back,
+the frames, progress and the result, is put on a queue, which the window
+empties from its own event loop:
+
+('frame', (index, image)) :                 a frame with the tracks drawn on it.
+('position', (index, (x, y))) :             a position found by track_spot,
+                                            or by track_spots, a list of
+                                            (spot, (x, y)).
+('progress', (stage, done, total, message)) : see BrownianProfile.
+('done', result) :                          the value returned.
+('cancelled', result) :                     Cancel was called. result is what
+                                            was finished before it stopped, or
+                                            None.
+('error', text) :                           the traceback of an exception.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import traceback
+from threading import Thread, Event
+from Queue import Queue, Empty
+from BrownianSearch import window_centers, nearest_blob_center, \
+     draw_points, Spot_Predictor
+from MultipleBeadBrownian import Multiple_Spot_Track, Track_Renderer
+from BrownianProfile import Profile
+
+class Cancelled(Exception):
+    '''Raised in the worker thread when the job is cancelled. 'result' holds
+    whatever the job had finished.'''
+    result = None
+
+def track_spot(im_seq, start_frame, position, threshold, max_dist, \
+               localization = 'centroid', search = 'window', profile = None, \
+               frame_writer = None, position_writer = None):
+    '''Follows the spot at 'position' in frame start_frame of the frame source
+    im_seq until it has been missing for three frames or the sequence ends,
+    as Spot_Track does. Returns the list of (index, (x, y)) positions of the
+    frames in which the spot was found, so frames in which it was missing
+    leave gaps. frame_writer, if given, is called with each frame with the
+    spot drawn on it, and position_writer with each position.'''
+    writer = None
+    if position_writer is not None:
+        def writer(index, found):
+            if found:
+                position_writer(index, found[0][1])
+
+    try:
+        return track_spots(im_seq, start_frame, [position], threshold, \
+                           max_dist, localization, search, profile, \
+                           frame_writer, writer)[0]
+    except Cancelled, error:
+        error.result = error.result[0]
+        raise
+
+def track_spots(im_seq, start_frame, positions, threshold, max_dist, \
+                localization = 'centroid', search = 'window', profile = None, \
+                frame_writer = None, position_writer = None):
+    '''Follows the spots at each of the (x, y) 'positions' in frame
+    start_frame of the frame source im_seq, as track_spot follows one, reading
+    each frame once for all of them. The search windows of all of the spots
+    are found together (see window_centers). Returns a list with the
+    positions of each spot, as track_spot returns them. frame_writer, if
+    given, is called with each frame with the spots drawn on it, and
+    position_writer with the positions of the spots found in it.'''
+    if profile is None:
+        profile = Profile()
+
+    n = len(positions)
+    spot_locs = [tuple(position) for position in positions]
+    misses = [1]*n
+    predictors = [Spot_Predictor(spot_loc, max_dist) for spot_loc in spot_locs]
+    tracks = [[] for k in xrange(n)]
+    live = range(n)
+    i = start_frame
+    width, height = im_seq[0].size
+
+    if n == 1:
+        profile.Message('track', 'Tracking Spot...')
+    else:
+        profile.Message('track', 'Tracking %d Spots...' % n)
+
+    try:
+        with profile.Stage('track'):
+            while i < len(im_seq) and live:
+                pixels = im_seq.Get_array(i)
+
+                if search == 'predictive':
+                    bboxes = [predictors[k].Search_box() for k in live]
+                    centers = [nearest_blob_center(pixels, threshold, bbox, \
+                                                   predictors[k].Prediction(), \
+                                                   localization) \
+                               for (k, bbox) in zip(live, bboxes)]
+                else:
+                    bboxes = [[int(spot_locs[k][0]+0.5) - max_dist*misses[k], \
+                               int(spot_locs[k][1]+0.5) - max_dist*misses[k], \
+                               int(spot_locs[k][0]+0.5) + max_dist*misses[k], \
+                               int(spot_locs[k][1]+0.5) + max_dist*misses[k]] \
+                              for k in live]
+                    centers = window_centers(pixels, threshold, bboxes, \
+                                             localization)
+
+                profile.Add('frames')
+                profile.Add('pixels scanned', \
+                            sum(max(min(b[2], width) - max(b[0], 0), 0) * \
+                                max(min(b[3], height) - max(b[1], 0), 0) \
+                                for b in bboxes))
+
+                found = []
+                for (k, center) in zip(live, centers):
+                    if center is None:
+                        misses[k] += 1
+                        predictors[k].Missed()
+                        profile.Add('frames missed')
+                        if n == 1:
+                            profile.Message('track', \
+                                            'Cannot find spot in frame %d' % i)
+                        else:
+                            profile.Message('track', 'Cannot find spot %d '
+                                            'in frame %d' % (k + 1, i))
+                    else:
+                        spot_locs[k] = tuple(center)
+                        predictors[k].Found(center)
+                        misses[k] = 1
+                        tracks[k].append((i, spot_locs[k]))
+                        found.append((k, spot_locs[k]))
+
+                if position_writer is not None:
+                    position_writer(i, found)
+                if frame_writer is not None:
+                    frame_writer(i, draw_points([spot_locs[k] for k in live], \
+                                                im_seq[i]))
+
+                #A spot is given up once it has been missing for three frames.
+                live = [k for k in live if misses[k] < 4]
+                profile.Progress('track', i - start_frame + 1, \
+                                 len(im_seq) - start_frame)
+                i += 1
+    except Cancelled, error:
+        error.result = tracks
+        raise
+
+    profile.Message('track', 'Done.')
+    return tracks
+
+def track_all_spots(im_seq, start_frame, threshold, max_dist, \
+                    localization = 'centroid', cache = None, profile = None, \
+                    frame_writer = None):
+    '''Runs the multiple spot tracker from start_frame to the end of the frame
+    source im_seq and returns the Multiple_Spot_Track. frame_writer, if given,
+    is called with each frame with the tracks drawn on it, as Draw_track
+    would draw them. The frames are not kept by the tracker.'''
+    tracker = Multiple_Spot_Track(max_frames = 3, max_dist = max_dist, \
+                                  threshold = threshold, \
+                                  start_frame = start_frame, \
+                                  im_seq = im_seq, \
+                                  localization = localization, \
+                                  cache = cache, profile = profile)
+    if frame_writer is not None:
+        with tracker.profile.Stage('render'):
+            renderer = Track_Renderer(tracker.table, tracker.im_size)
+            for i in xrange(tracker.start_frame, tracker.end_frame):
+                frame_writer(i, renderer.Render(im_seq[i], i))
+                tracker.profile.Progress('render', i - start_frame + 1, \
+                                         tracker.end_frame - start_frame)
+    return tracker
+
+class Tracking_Worker:
+    def __init__(self, function, *args, **kwargs):
+        '''Starts calling function(*args, **kwargs) on a new thread, adding
+        the keyword argument profile, and a writer for each of the names in
+        the keyword argument 'writers', by default just 'frame_writer'. A
+        writer called name_writer puts ('name', (index, value)) on the queue.
+        A Profile may be passed as 'profile'; its progress function is
+        replaced while the job runs.'''
+        self.queue = Queue()
+        self.cancelled = Event()
+
+        self.profile = kwargs.pop('profile', None)
+        if self.profile is None:
+            self.profile = Profile()
+        self.profile.progress = self.Progress
+        kwargs['profile'] = self.profile
+        for name in kwargs.pop('writers', ('frame_writer',)):
+            kwargs[name] = self.Writer(name[:-len('_writer')])
+
+        self.thread = Thread(target = self.Run, args = (function, args, \
+                                                        kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Run(self, function, args, kwargs):
+        try:
+            message = ('done', function(*args, **kwargs))
+        except Cancelled, error:
+            message = ('cancelled', error.result)
+        except Exception:
+            message = ('error', traceback.format_exc())
+
+        #Given back before the last message, which may start another job,
+        #unless another job has taken it already.
+        if self.profile.progress == self.Progress:
+            self.profile.progress = None
+        self.queue.put(message)
+
+    def Writer(self, kind):
+        '''Returns a writer for the job, which puts (kind, (index, value)) on
+        the queue.'''
+        def write(index, value):
+            if self.cancelled.is_set():
+                raise Cancelled()
+            self.queue.put((kind, (index, value)))
+        return write
+
+    def Progress(self, stage, done, total, message):
+        '''The progress function of the job's profile.'''
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.queue.put(('progress', (stage, done, total, message)))
+
+    def Cancel(self):
+        '''Asks the job to stop at the next frame or progress report.'''
+        self.cancelled.set()
+
+    def Running(self):
+        return self.thread.is_alive()
+
+    def Messages(self):
+        '''Returns the messages waiting on the queue, without waiting for
+        more.'''
+        messages = []
+        while True:
+            try:
+                messages.append(self.queue.get_nowait())
+            except Empty:
+                return messages
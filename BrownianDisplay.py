@@ -0,0 +1,172 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the display side of the
+Spot Tracker window: the frames as they are shown, and the tracks drawn over
+them.
+
+Display_Cache keeps the frames ready to be shown: shrunk to fit the screen
+and in RGB, as the window's PhotoImage wants them. Jpeg frames are decoded
+at a smaller scale when they are to be shrunk (see BrownianFrames). The most
+recently shown frames are kept, and a thread prepares the frames either side
+of the one shown, so moving the slider a frame at a time doesn't wait for
+decoding.
+
+Track_Overlay draws the tracks as lines and squares on the Tk canvas, above
+the frame, instead of into a copy of each frame. Moving to another frame
+only moves the ends of the tracks that changed.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from threading import Thread
+from Queue import Queue, Empty
+from numpy import bincount, flatnonzero, arange, repeat
+from PIL import Image
+from BrownianFrames import Lru_cache
+
+#Largest size the frames are shown at, in pixels.
+MAX_DISPLAY = (1280, 960)
+
+#Number of prepared frames kept, and prepared either side of the one shown.
+DISPLAY_CACHE = 32
+PREFETCH = 3
+
+class Display_Cache:
+    def __init__(self, frames, max_size = MAX_DISPLAY, \
+                 cache_size = DISPLAY_CACHE, prefetch = PREFETCH):
+        '''Prepares the frames of the frame source 'frames' for display,
+        shrinking any larger than max_size. At most cache_size prepared
+        frames are kept, and 'prefetch' frames either side of the last one
+        asked for are prepared on a thread.'''
+        self.frames = frames
+        width, height = frames[0].size
+        self.scale = min(1.0, max_size[0] / float(width), \
+                         max_size[1] / float(height))
+        self.size = (max(int(width*self.scale + 0.5), 1), \
+                     max(int(height*self.scale + 0.5), 1))
+        self.cache = Lru_cache(cache_size)
+        self.prefetch = prefetch
+
+        self.requests = Queue()
+        self.thread = Thread(target = self.Prefetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Prepare(self, i):
+        '''Returns frame i as it is shown.'''
+        image = self.frames.Preview(i, self.size)
+        if image.size != self.size:
+            image = image.resize(self.size, Image.BILINEAR)
+        return image.convert('RGB')
+
+    def Get(self, i):
+        '''Returns frame i as it is shown, and starts preparing the frames
+        around it.'''
+        image = self.cache.Get(i)
+        if image is None:
+            image = self.Prepare(i)
+            self.cache.Put(i, image)
+        if self.prefetch > 0:
+            self.requests.put(i)
+        return image
+
+    def Prefetch(self):
+        '''Run on the thread: prepares the frames nearest the one last asked
+        for, nearest first, starting again whenever another is asked for.'''
+        while True:
+            i = self.requests.get()
+            try:
+                while True:
+                    i = self.requests.get_nowait()
+            except Empty:
+                pass
+            if i is None:
+                return
+
+            for d in xrange(1, self.prefetch + 1):
+                for j in (i + d, i - d):
+                    if 0 <= j < len(self.frames) and j not in self.cache:
+                        self.cache.Put(j, self.Prepare(j))
+                if not self.requests.empty():
+                    break
+
+    def To_frame(self, x, y):
+        '''Converts a point on the display to frame coordinates.'''
+        return (x / self.scale, y / self.scale)
+
+    def Close(self):
+        '''Stops the prefetching thread and empties the cache.'''
+        self.requests.put(None)
+        self.cache.Clear()
+
+class Track_Overlay:
+    def __init__(self, canvas, table, scale = 1.0, d = 2):
+        '''Draws the tracks in the track table (see BrownianTracks) on the Tk
+        canvas 'canvas', in the colours of draw_chain, with the frame
+        coordinates multiplied by 'scale'. Each track's position in the frame
+        shown is marked with a square of half width d.'''
+        self.canvas = canvas
+        self.table = table
+        self.scale = scale
+        self.d = d
+
+        n = len(table)
+        k = arange(n)
+        self.colours = ['#%02x%02x%02x' % (255-(255*i)/max(n, 1), 0, \
+                                           (255*i)/max(n, 1)) for i in k]
+        self.row_track = repeat(k, table.Lengths())
+        self.xs = (table.x*scale).tolist()
+        self.ys = (table.y*scale).tolist()
+
+        self.lines = [canvas.create_line(0, 0, 0, 0, fill = colour, \
+                                         state = 'hidden') \
+                      for colour in self.colours]
+        self.squares = [canvas.create_rectangle(0, 0, 0, 0, fill = colour, \
+                                                outline = colour, \
+                                                state = 'hidden') \
+                        for colour in self.colours]
+        self.shown = [0]*n
+        self.marked = []
+
+    def Show(self, index):
+        '''Draws each track up to frame 'index'.'''
+        starts = self.table.starts
+        counts = bincount(self.row_track[self.table.frame <= index], \
+                          minlength = len(self.table))
+
+        for k in flatnonzero(counts != self.shown):
+            count = counts[k]
+            if count < 2:
+                self.canvas.itemconfigure(self.lines[k], state = 'hidden')
+            else:
+                first = starts[k]
+                points = []
+                for r in xrange(first, first + count):
+                    points.extend((self.xs[r], self.ys[r]))
+                self.canvas.coords(self.lines[k], *points)
+                self.canvas.itemconfigure(self.lines[k], state = 'normal')
+            self.shown[k] = count
+
+        for k in self.marked:
+            self.canvas.itemconfigure(self.squares[k], state = 'hidden')
+        self.marked = []
+        d = self.d
+        for r in flatnonzero(self.table.frame == index):
+            k = self.row_track[r]
+            x, y = self.xs[r], self.ys[r]
+            self.canvas.coords(self.squares[k], x-d, y-d, x+d, y+d)
+            self.canvas.itemconfigure(self.squares[k], state = 'normal')
+            self.marked.append(k)
+
+    def Hide(self):
+        '''Hides all of the tracks.'''
+        for item in self.lines + self.squares:
+            self.canvas.itemconfigure(item, state = 'hidden')
+        self.shown = [0]*len(self.shown)
+        self.marked = []
+
+    def Delete(self):
+        '''Removes the tracks from the canvas.'''
+        for item in self.lines + self.squares:
+            self.canvas.delete(item)
+        self.lines, self.squares = [], []
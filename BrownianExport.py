@@ -0,0 +1,226 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the writers and readers
+of track files, for the tracks of either tracker.
+
+Two formats are supported, chosen by the file extension:
+
+.trk :          A binary file of the track table columns (see BrownianTracks),
+                written in chunks. The file starts with the metadata (the
+                tracking parameters, frame rate, source file and so on) and
+                more chunks can be appended at any time, so tracks can be
+                written as a streaming run finds them. Each chunk records the
+                range of tracks it holds, so part of the file can be read
+                without reading the rest.
+.txt, .tsv :    Tab delimited text with one line per position.
+.csv :          Comma separated text with one line per position.
+
+Layout of a .trk file, all numbers little endian:
+
+    'BSTRACK1', uint32 length, the metadata as JSON
+    then for each chunk:
+    'CHNK', uint32 rows, int32 first track, int32 last track,
+    int32 first frame, int32 last frame, then each column in turn.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import os.path
+import json
+import struct
+from numpy import fromfile, dtype, concatenate, zeros
+from BrownianTracks import Track_Table, table_from_tracks, COLUMNS, TYPES
+
+MAGIC = 'BSTRACK1'
+CHUNK = 'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIiiii')
+
+#Number of rows collected before a chunk is written.
+CHUNK_ROWS = 1 << 16
+
+#On disk types of the columns.
+DISK_TYPES = [dtype(t).newbyteorder('<') for t in TYPES]
+ROW_BYTES = sum(t.itemsize for t in DISK_TYPES)
+
+class Track_Writer:
+    def __init__(self, filename, metadata = None, append = False, \
+                 chunk_rows = CHUNK_ROWS):
+        '''Opens a .trk file for writing, storing the dictionary 'metadata'
+        at its start. If append is True and the file exists, new chunks are
+        added to the end of it instead and its metadata is kept.'''
+        self.filename = filename
+        self.chunk_rows = chunk_rows
+        self.pending = []
+        self.pending_rows = 0
+        self.next_id = 0
+
+        if append and os.path.isfile(filename):
+            self.metadata = read_metadata(filename)
+            for header in chunk_headers(filename):
+                self.next_id = max(self.next_id, header['last track'] + 1)
+            self.file = open(filename, 'ab')
+        else:
+            self.metadata = metadata or {}
+            self.file = open(filename, 'wb')
+            text = json.dumps(self.metadata)
+            self.file.write(MAGIC + struct.pack('<I', len(text)) + text)
+
+    def Write(self, table):
+        '''Adds the rows of the Track_Table, keeping its track ids.'''
+        if table.Size() == 0:
+            return
+        self.pending.append(table)
+        self.pending_rows += table.Size()
+        self.next_id = max(self.next_id, int(table.track_id.max()) + 1)
+        if self.pending_rows >= self.chunk_rows:
+            self.Flush()
+
+    def Write_tracks(self, tracks):
+        '''Adds a list of tracks, each a list of (index, (x, y)) as in
+        Multiple_Spot_Track.tracks, numbering them after the tracks already
+        written.'''
+        table = table_from_tracks(list(tracks))
+        table.track_id += self.next_id
+        self.Write(table)
+
+    def Flush(self):
+        '''Writes the rows collected so far as one chunk.'''
+        if self.pending_rows == 0:
+            return
+        columns = [concatenate([getattr(t, name) for t in self.pending]) \
+                   for name in COLUMNS]
+        self.pending, self.pending_rows = [], 0
+
+        track_id, frame = columns[0], columns[1]
+        self.file.write(CHUNK_HEADER.pack(CHUNK, len(track_id), \
+                        track_id.min(), track_id.max(), frame.min(), \
+                        frame.max()))
+        for column, kind in zip(columns, DISK_TYPES):
+            self.file.write(column.astype(kind).tostring())
+        self.file.flush()
+
+    def Close(self):
+        '''Writes any remaining rows and closes the file.'''
+        self.Flush()
+        self.file.close()
+
+class Text_Writer:
+    def __init__(self, filename, metadata = None, append = False, \
+                 delimiter = '\t'):
+        '''Opens a text file for writing tracks with one line per position.
+        The metadata is written as comment lines starting with '#'.'''
+        self.delimiter = delimiter
+        self.next_id = 0
+        self.file = open(filename, 'a' if append else 'w')
+        if not append:
+            for key in sorted(metadata or {}):
+                self.file.write('# %s: %s\n' % (key, metadata[key]))
+            self.file.write(delimiter.join(['track', 'frame', 'x pos', \
+                                            'y pos', 'area', \
+                                            'intensity']) + '\n')
+        self.line = delimiter.join(['%d', '%d', '%.2f', '%.2f', '%d', \
+                                    '%.1f']) + '\n'
+
+    def Write(self, table):
+        '''Adds the rows of the Track_Table, keeping its track ids.'''
+        rows = zip(*[getattr(table, name).tolist() for name in COLUMNS])
+        self.file.writelines(self.line % row for row in rows)
+        if table.Size():
+            self.next_id = max(self.next_id, int(table.track_id.max()) + 1)
+
+    def Write_tracks(self, tracks):
+        '''Adds a list of tracks, numbering them after the tracks already
+        written.'''
+        table = table_from_tracks(list(tracks))
+        table.track_id += self.next_id
+        self.Write(table)
+
+    def Flush(self):
+        self.file.flush()
+
+    def Close(self):
+        self.file.close()
+
+def track_writer(filename, metadata = None, append = False):
+    '''Returns a writer for the format given by the file extension.'''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.trk':
+        return Track_Writer(filename, metadata, append)
+    elif extension == '.csv':
+        return Text_Writer(filename, metadata, append, ',')
+    return Text_Writer(filename, metadata, append)
+
+def export_tracks(tracks, filename, metadata = None):
+    '''Saves the tracks, either a Track_Table or a list of tracks, in the
+    format given by the file extension. Returns the number of tracks.'''
+    writer = track_writer(filename, metadata)
+    if isinstance(tracks, Track_Table):
+        writer.Write(tracks)
+        n = len(tracks)
+    else:
+        tracks = list(tracks)
+        writer.Write_tracks(tracks)
+        n = len(tracks)
+    writer.Close()
+    return n
+
+def read_metadata(filename):
+    '''Returns the metadata dictionary stored at the start of a .trk file.'''
+    data = open(filename, 'rb')
+    if data.read(len(MAGIC)) != MAGIC:
+        data.close()
+        raise ValueError('%s is not a track file' % filename)
+    (length,) = struct.unpack('<I', data.read(4))
+    metadata = json.loads(data.read(length))
+    data.close()
+    return metadata
+
+def chunk_headers(filename):
+    '''Returns a list with a dictionary describing each chunk of a .trk file:
+    its offset in the file, number of rows and range of tracks and frames.'''
+    data = open(filename, 'rb')
+    data.seek(len(MAGIC))
+    (length,) = struct.unpack('<I', data.read(4))
+    data.seek(length, 1)
+
+    headers = []
+    while True:
+        raw = data.read(CHUNK_HEADER.size)
+        if len(raw) < CHUNK_HEADER.size:
+            break
+        magic, rows, first, last, first_frame, last_frame = \
+               CHUNK_HEADER.unpack(raw)
+        if magic != CHUNK:
+            raise ValueError('%s is damaged' % filename)
+        headers.append({'offset': data.tell(), 'rows': rows,
+                        'first track': first, 'last track': last,
+                        'first frame': first_frame, 'last frame': last_frame})
+        data.seek(rows*ROW_BYTES, 1)
+    data.close()
+
+    return headers
+
+def read_tracks(filename, first_track = None, last_track = None):
+    '''Returns the tracks stored in a .trk file as a Track_Table. If
+    first_track or last_track are given, only tracks with ids in that range
+    (including both) are returned, and chunks holding none of them are not
+    read.'''
+    low = first_track if first_track is not None else -2**31
+    high = last_track if last_track is not None else 2**31 - 1
+
+    data = open(filename, 'rb')
+    parts = [[] for name in COLUMNS]
+    for header in chunk_headers(filename):
+        if header['last track'] < low or header['first track'] > high:
+            continue
+        data.seek(header['offset'])
+        columns = [fromfile(data, kind, header['rows']) \
+                   for kind in DISK_TYPES]
+        keep = (columns[0] >= low) & (columns[0] <= high)
+        for part, column in zip(parts, columns):
+            part.append(column[keep])
+    data.close()
+
+    columns = [concatenate(part) if part else zeros(0, kind) \
+               for part, kind in zip(parts, DISK_TYPES)]
+    return Track_Table(*columns)
@@ -0,0 +1,525 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the frame sources used
+by both the single and multiple spot trackers to read image sequences without
+loading every frame into memory.
+
+A frame source behaves like a read only list of PIL images: it supports len(),
+indexing, iteration and slicing (which returns another frame source, not a
+list). The method Get_array(i) returns frame i as a 2D numpy array, which for
+uncompressed Tiff files is a view straight into the memory mapped file.
+
+Frames that have to be decoded are read through a Prefetch_Frames, which
+decodes the next few frames on a pool of threads while the current one is
+being worked on, so decoding and tracking go on at the same time. For the
+display, Preview(i, size) returns a frame that need only be as large as
+'size', which Jpeg files decode at a half, a quarter or an eighth of their
+full size much more quickly.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import os
+import os.path
+from hashlib import sha1
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from collections import OrderedDict
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
+from PIL import Image
+from numpy import memmap, asarray, ndarray, dtype, frombuffer
+
+#Number of decoded frames kept in memory by sources that can't be mapped.
+CACHE_SIZE = 64
+
+#Number of threads decoding frames, and of frames decoded ahead of the last
+#one read, by Prefetch_Frames.
+DECODE_THREADS = 2
+READ_AHEAD = 8
+
+#Tiff tags needed to locate the raw pixels of a page in the file.
+COMPRESSION, STRIP_OFFSETS, STRIP_BYTE_COUNTS = 259, 273, 279
+
+#Number of bytes read at a time when hashing a file, see file_key.
+HASH_BLOCK = 1 << 24
+
+#Numpy types for the image modes that can be read straight from the file.
+RAW_MODES = {'L': 'u1', 'I;16': '<u2', 'I;16B': '>u2'}
+
+class Lru_cache:
+    def __init__(self, size = CACHE_SIZE):
+        '''A dictionary that holds at most 'size' items, dropping the least
+        recently used item when a new one is added.'''
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def Get(self, key, default = None):
+        '''Returns the item stored under key, or default if there is none.'''
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def Put(self, key, value):
+        '''Stores the value under key, evicting old items if needed.'''
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last = False)
+
+    def Clear(self):
+        '''Removes all items.'''
+        with self.lock:
+            self.items.clear()
+
+class Frame_Sequence(object):
+    '''Base class of the frame sources. Subclasses define Load_frame(i),
+    returning frame i as a PIL image, and may override Load_array(i).'''
+
+    length = 0
+
+    #True if the pixels are held by this process and would have to be copied
+    #to be read by another one, see Shared_Frames.
+    in_memory = False
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Frame_Slice(self, *index.indices(len(self)))
+        return self.Load_frame(self.Index(index))
+
+    def Index(self, index):
+        '''Checks the index and turns negative indices into positive ones.'''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame index out of range')
+        return index
+
+    def Get_array(self, index):
+        '''Returns frame 'index' as a 2D numpy array.'''
+        return self.Load_array(self.Index(index))
+
+    def Preview(self, index, size):
+        '''Returns frame 'index' as a PIL image for display, no smaller than
+        the (width, height) 'size' where the frame is that large, but maybe
+        smaller than the full frame.'''
+        return self.Load_preview(self.Index(index), size)
+
+    def Frame_key(self, index):
+        '''Returns a string that identifies the contents of frame 'index', the
+        same for the same frame of the same file however it is opened.'''
+        return self.Load_key(self.Index(index))
+
+    def Reopened(self):
+        '''Returns the source as another process should read it, with files
+        of its own. A forked process inherits the open files of its parent,
+        sharing their positions with it, so it can't read them safely.'''
+        return loads(dumps(self, HIGHEST_PROTOCOL))
+
+    def Load_array(self, i):
+        return asarray(self.Load_frame(i))
+
+    def Load_key(self, i):
+        return array_key(self.Load_array(i))
+
+    def Load_preview(self, i, size):
+        return self.Load_frame(i)
+
+class Frame_Slice(Frame_Sequence):
+    def __init__(self, source, start, stop, step):
+        '''A lazy view of the frames start:stop:step of another source.'''
+        self.source = source
+        self.start = start
+        self.step = step
+        self.length = len(xrange(start, stop, step))
+        self.in_memory = source.in_memory
+
+    def Load_frame(self, i):
+        return self.source.Load_frame(self.start + i*self.step)
+
+    def Load_array(self, i):
+        return self.source.Load_array(self.start + i*self.step)
+
+    def Load_key(self, i):
+        return self.source.Load_key(self.start + i*self.step)
+
+    def Load_preview(self, i, size):
+        return self.source.Load_preview(self.start + i*self.step, size)
+
+class List_Frames(Frame_Sequence):
+
+    in_memory = True
+
+    def __init__(self, frames):
+        '''Wraps a list of PIL images, or of 2D arrays, already in memory.'''
+        self.frames = frames
+        self.length = len(frames)
+
+    def Load_frame(self, i):
+        frame = self.frames[i]
+        if isinstance(frame, ndarray):
+            return Image.fromarray(frame)
+        return frame
+
+    def Load_array(self, i):
+        return asarray(self.frames[i])
+
+class Decoded_Frames(Frame_Sequence):
+    def __init__(self, filename, cache_size = CACHE_SIZE):
+        '''Reads the frames of a Tiff or Gif file as they are needed, keeping
+        the most recently used decoded frames in memory. Each page of a Tiff
+        file can be decoded on its own, so each thread reading them opens the
+        file for itself. Gif frames build on the ones before, so they are
+        read one at a time from the same open file.'''
+        self.filename = filename
+        self.image = Image.open(filename)
+        self.length = getattr(self.image, 'n_frames', 1)
+        self.cache = Lru_cache(cache_size)
+        self.lock = Lock()
+        self.threads = local()
+        self.shared = self.image.format != 'TIFF'
+
+    def __getstate__(self):
+        return (self.filename, self.cache.size)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def Load_key(self, i):
+        return '%s:%d' % (file_key(self.filename), i)
+
+    def Load_frame(self, i):
+        frame = self.cache.Get(i)
+        if frame is None:
+            if self.shared:
+                with self.lock:
+                    self.image.seek(i)
+                    frame = self.image.copy()
+            else:
+                #A forked process opens the file again rather than sharing
+                #the parent's position in it.
+                if getattr(self.threads, 'pid', None) != os.getpid():
+                    self.threads.image = Image.open(self.filename)
+                    self.threads.pid = os.getpid()
+                image = self.threads.image
+                image.seek(i)
+                frame = image.copy()
+            self.cache.Put(i, frame)
+        return frame
+
+class Image_Files(Frame_Sequence):
+    def __init__(self, filenames, cache_size = CACHE_SIZE):
+        '''Reads a sequence of image files, one frame per file, as they are
+        needed, keeping the most recently used decoded frames in memory.'''
+        self.filenames = filenames
+        self.length = len(filenames)
+        self.cache = Lru_cache(cache_size)
+
+    def __getstate__(self):
+        return (self.filenames, self.cache.size)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def Load_key(self, i):
+        return file_key(self.filenames[i])
+
+    def Load_frame(self, i):
+        frame = self.cache.Get(i)
+        if frame is None:
+            frame = Image.open(self.filenames[i])
+            frame.load()
+            self.cache.Put(i, frame)
+        return frame
+
+    def Load_preview(self, i, size):
+        '''Jpeg files are decoded straight to the smallest scale no smaller
+        than 'size'. The preview isn't cached, as the frame would be.'''
+        frame = self.cache.Get(i)
+        if frame is None:
+            frame = Image.open(self.filenames[i])
+            frame.draft(frame.mode, size)
+            frame.load()
+        return frame
+
+class Prefetch_Frames(Frame_Sequence):
+    def __init__(self, source, workers = DECODE_THREADS, ahead = READ_AHEAD):
+        '''Reads the frames of a source that decodes them, such as
+        Decoded_Frames or Image_Files, decoding the 'ahead' frames after the
+        last one read on 'workers' threads. No more than 'ahead' frames are
+        waiting to be decoded at once, however the frames are read. The
+        frames decoded are kept in the source's cache.'''
+        self.source = source
+        self.length = len(source)
+        self.workers = workers
+        self.ahead = ahead
+        self.pool = None
+        self.pid = None
+
+    def __getstate__(self):
+        return (self.source, self.workers, self.ahead)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __del__(self):
+        self.Close()
+
+    def Reopened(self):
+        #Worker processes are each given a few frames at a time, and
+        #decoding past the last of them would only duplicate the work of
+        #other workers, so they read the source itself.
+        return self.source.Reopened()
+
+    def Start(self):
+        '''Starts the threads, and does so again in a process forked from the
+        one that started them, where they don't run. The locks are replaced
+        too, as threads that are gone may have held them.'''
+        if self.pid is not None:
+            self.source.cache.lock = Lock()
+            if hasattr(self.source, 'lock'):
+                self.source.lock = Lock()
+        self.lock = Lock()
+        self.pending = {}
+        self.outstanding = 0
+        self.pool = ThreadPool(self.workers)
+        self.pid = os.getpid()
+
+    def Close(self):
+        '''Stops the decoding threads. They are started again if another frame
+        is read.'''
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.terminate()
+        self.pool = None
+        self.pid = None
+
+    def Decode(self, i):
+        '''Run on the threads: decodes frame i into the source's cache.'''
+        try:
+            return self.source.Load_frame(i)
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+
+    def Load_frame(self, i):
+        if self.pid != os.getpid():
+            self.Start()
+
+        with self.lock:
+            job = self.pending.pop(i, None)
+
+            #Jobs that are done, or not among the next frames, are forgotten,
+            #though those still running count until they finish. Those done
+            #left their frame in the source's cache.
+            last = min(i + self.ahead, self.length - 1)
+            self.pending = dict((j, pending) for (j, pending) \
+                                in self.pending.iteritems() \
+                                if i < j <= last and not pending.ready())
+            for j in xrange(i + 1, last + 1):
+                if self.outstanding >= self.ahead:
+                    break
+                if j not in self.pending and j not in self.source.cache:
+                    self.outstanding += 1
+                    self.pending[j] = self.pool.apply_async(self.Decode, (j,))
+
+        if job is not None:
+            return job.get()
+        return self.source.Load_frame(i)
+
+    def Load_key(self, i):
+        return self.source.Load_key(i)
+
+    def Load_preview(self, i, size):
+        return self.source.Load_preview(i, size)
+
+class Mapped_Tiff(Frame_Sequence):
+    def __init__(self, filename, pages):
+        '''Reads the frames of an uncompressed Tiff file directly from the
+        memory mapped file. 'pages' is a list of (offset, (height, width),
+        type) for each frame, as found by tiff_pages.'''
+        self.filename = filename
+        self.pages = pages
+        self.length = len(pages)
+        self.data = memmap(filename, dtype = 'u1', mode = 'r')
+
+    def __getstate__(self):
+        #Other processes map the file again rather than copying the pixels.
+        return (self.filename, self.pages)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def Load_key(self, i):
+        return '%s:%d' % (file_key(self.filename), i)
+
+    def Load_array(self, i):
+        offset, shape, kind = self.pages[i]
+        kind = dtype(kind)
+        size = shape[0]*shape[1]*kind.itemsize
+        return self.data[offset:offset+size].view(kind).reshape(shape)
+
+    def Load_frame(self, i):
+        array = self.Load_array(i)
+        if not array.dtype.isnative:
+            array = array.astype(array.dtype.newbyteorder('='))
+        return Image.fromarray(array)
+
+class Shared_Frames(Frame_Sequence):
+    def __init__(self, frames, indices = None):
+        '''Copies the frames of another source, or only those whose indices
+        are listed, into one block of shared memory that worker processes
+        started afterwards can read without the pixels being pickled. All
+        frames must have the same size and type.'''
+        if indices is None:
+            indices = xrange(len(frames))
+        first = asarray(frames.Get_array(indices[0]))
+        self.length = len(indices)
+        self.shape = first.shape
+        self.kind = first.dtype.str
+        self.buffer = RawArray('c', self.length*first.nbytes)
+
+        stack = self.Stack()
+        for k, i in enumerate(indices):
+            stack[k] = frames.Get_array(i)
+
+    def Reopened(self):
+        #The shared memory is inherited, and can't be pickled.
+        return self
+
+    def Stack(self):
+        '''Returns all of the frames as one 3D array using the shared memory.'''
+        return frombuffer(self.buffer, dtype = self.kind).reshape(
+            (self.length,) + self.shape)
+
+    def Load_array(self, i):
+        return self.Stack()[i]
+
+    def Load_frame(self, i):
+        return Image.fromarray(self.Load_array(i))
+
+#Keys of the files already hashed, by (name, size, modification time).
+file_keys = {}
+
+def file_key(filename):
+    '''Returns the SHA-1 hash of the file's size and contents, as a hex
+    string. The file is read HASH_BLOCK bytes at a time, so huge stacks are
+    never held in memory, and each file is only hashed again once its size or
+    modification time changes.'''
+    stat = os.stat(filename)
+    name = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if name in file_keys:
+        return file_keys[name]
+
+    digest = sha1(str(stat.st_size))
+    data = open(filename, 'rb')
+    block = data.read(HASH_BLOCK)
+    while block:
+        digest.update(block)
+        block = data.read(HASH_BLOCK)
+    data.close()
+
+    file_keys[name] = digest.hexdigest()
+    return file_keys[name]
+
+def array_key(array):
+    '''Returns the SHA-1 hash of the contents, shape and type of the array.'''
+    array = asarray(array)
+    digest = sha1(str((array.shape, array.dtype.str)))
+    digest.update(array.tostring())
+    return digest.hexdigest()
+
+def tiff_pages(image):
+    '''Returns a list of (offset, (height, width), type) giving where the
+    pixels of each page of the open Tiff image are stored, or None if any page
+    is compressed or not stored as one contiguous block.'''
+    pages = []
+    for i in xrange(getattr(image, 'n_frames', 1)):
+        image.seek(i)
+        tags = image.tag_v2
+        if image.mode not in RAW_MODES or tags.get(COMPRESSION, 1) != 1:
+            return None
+
+        offsets = tags.get(STRIP_OFFSETS)
+        counts = tags.get(STRIP_BYTE_COUNTS)
+        if offsets is None or counts is None:
+            return None
+        if isinstance(offsets, int):
+            offsets, counts = (offsets,), (counts,)
+
+        for k in xrange(len(offsets)-1):
+            if offsets[k] + counts[k] != offsets[k+1]:
+                return None
+
+        (width, height) = image.size
+        kind = RAW_MODES[image.mode]
+        if sum(counts) < width*height*dtype(kind).itemsize:
+            return None
+
+        pages.append((offsets[0], (height, width), kind))
+
+    return pages
+
+def image_file_sequence(filename):
+    '''Returns the list of files in the sequence starting at 'filename', where
+    the files are named as "ImagenameFramenumber.jpg". The directory is
+    listed once, rather than looking for each file in turn.'''
+    directory, im_name = os.path.split(filename)
+    im_num = int(''.join(s for s in im_name if s.isdigit()))
+    im_name = ''.join(s for s in im_name if not s.isdigit())[:-4]
+
+    listed = set(os.listdir(directory or '.'))
+    filenames = []
+    while im_name+str(im_num)+'.jpg' in listed:
+        filenames.append(os.path.join(directory, im_name+str(im_num)+'.jpg'))
+        im_num += 1
+
+    return filenames
+
+def open_frames(filename, cache_size = CACHE_SIZE, \
+                workers = DECODE_THREADS):
+    '''Returns a frame source for the Tiff or Gif file, or for the sequence of
+    images starting with the given Jpeg file. Uncompressed Tiff files are
+    memory mapped, anything else is decoded as the frames are needed, ahead of
+    time on 'workers' threads if there are any (see Prefetch_Frames).'''
+    extension = filename[-3:].lower()
+
+    if extension == 'tif':
+        image = Image.open(filename)
+        pages = tiff_pages(image)
+        if pages is not None:
+            return Mapped_Tiff(filename, pages)
+        frames = Decoded_Frames(filename, cache_size)
+    elif extension == 'gif':
+        #Gif frames are read in order, as seeking back decodes from the start.
+        frames = Decoded_Frames(filename, cache_size)
+        workers = min(workers, 1)
+    else:
+        frames = Image_Files(image_file_sequence(filename), cache_size)
+
+    if workers > 0:
+        return Prefetch_Frames(frames, workers)
+    return frames
+
+def as_frame_sequence(frames):
+    '''Returns 'frames' as a frame source, wrapping it if it is a list.'''
+    if isinstance(frames, Frame_Sequence):
+        return frames
+    return List_Frames(frames)
@@ -0,0 +1,134 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the sub-pixel location
+of the spots, used by both the single and multiple spot trackers.
+
+Three methods are available:
+
+'centroid' :    the mean position of the pixels below the threshold. This is
+                what the trackers have always used.
+'weighted' :    the mean position of the pixels below the threshold, each
+                weighted by how far below the threshold it is.
+'gaussian' :    a 2D Gaussian spot fitted to the pixels around the weighted
+                centroid, by least squares. All of the spots in a frame are
+                fitted together, as arrays.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from numpy import nonzero, bincount, zeros, arange, exp, rint, clip, \
+     concatenate, stack, eye, isfinite, abs as absolute, einsum
+from numpy.linalg import solve, LinAlgError
+
+METHODS = ('centroid', 'weighted', 'gaussian')
+
+#Half width, in pixels, of the square fitted around each spot.
+FIT_RADIUS = 3
+
+def weighted_centers(frame, labels, n, threshold):
+    '''Returns an (n, 2) array of the (x, y) centers of the n groups in the
+    label array 'labels', each pixel weighted by threshold minus its value.'''
+    ys, xs = nonzero(labels)
+    ids = labels[ys, xs]
+    weights = threshold - frame[ys, xs].astype(float)
+
+    total = bincount(ids, weights, n+1)[1:]
+    centers = zeros((n, 2))
+    if n == 0:
+        return centers
+    centers[:, 0] = bincount(ids, weights*xs, n+1)[1:] / total
+    centers[:, 1] = bincount(ids, weights*ys, n+1)[1:] / total
+
+    return centers
+
+def patches(frame, centers, radius = FIT_RADIUS):
+    '''Returns (values, xs, ys): the (n, 2r+1, 2r+1) array of pixel values in
+    the square around the nearest pixel to each center, and the x and y
+    coordinates of those pixels. Squares that run over the edge of the frame
+    repeat the edge pixels.'''
+    offsets = arange(-radius, radius+1)
+    height, width = frame.shape[:2]
+
+    xs = clip(rint(centers[:, 0]).astype(int)[:, None] + offsets, 0, width-1)
+    ys = clip(rint(centers[:, 1]).astype(int)[:, None] + offsets, 0, height-1)
+    values = frame[ys[:, :, None], xs[:, None, :]].astype(float)
+
+    size = len(offsets)
+    xs = xs[:, None, :].repeat(size, 1)
+    ys = ys[:, :, None].repeat(size, 2)
+
+    return values, xs, ys
+
+def gaussian_centers(frame, centers, radius = FIT_RADIUS, iterations = 10, \
+                     width = 1.5):
+    '''Fits a dark 2D Gaussian spot, value = b - A*exp(-r^2/(2*s^2)), to the
+    pixels around each of the (x, y) starting centers, all at once. Returns the
+    (n, 2) array of fitted centers. Fits that fail, or that move the center
+    further than 'radius', keep their starting center. A spot whose fit meets
+    a singular matrix has failed, and the others carry on without it.'''
+    n = len(centers)
+    if n == 0:
+        return centers.copy()
+
+    values, xs, ys = patches(frame, centers, radius)
+    values = values.reshape(n, -1)
+    xs = xs.reshape(n, -1).astype(float)
+    ys = ys.reshape(n, -1).astype(float)
+
+    #Parameters x0, y0, A, b, s for each spot.
+    edge = concatenate((values[:, :2*radius+1], values[:, -2*radius-1:]), 1)
+    b = edge.mean(1)
+    p = stack((centers[:, 0], centers[:, 1], (b - values.min(1)).clip(1), b,
+               zeros(n) + width), 1)
+
+    damping = 1e-3
+    fitting = zeros(n, dtype = bool) + True
+    for k in xrange(iterations):
+        dx, dy = xs - p[:, 0:1], ys - p[:, 1:2]
+        r2 = dx*dx + dy*dy
+        s2 = p[:, 4:5]**2
+        g = exp(-r2/(2*s2))
+        residual = values - (p[:, 3:4] - p[:, 2:3]*g)
+
+        A_g = p[:, 2:3]*g
+        J = stack((-A_g*dx/s2, -A_g*dy/s2, -g, g*0 + 1,
+                   -A_g*r2/(s2*p[:, 4:5])), 2)
+
+        JTJ = einsum('npi,npj->nij', J, J)
+        JTJ += damping*JTJ*eye(5) + 1e-12*eye(5)
+        JTr = einsum('npi,np->ni', J, residual)
+        try:
+            step = solve(JTJ[fitting], JTr[fitting][:, :, None])[:, :, 0]
+        except LinAlgError:
+            #Solve the spots one at a time, and drop the singular ones.
+            step = zeros((n, 5))
+            for i in fitting.nonzero()[0]:
+                try:
+                    step[i] = solve(JTJ[i], JTr[i])
+                except LinAlgError:
+                    fitting[i] = False
+            step = step[fitting]
+        p[fitting] += step
+        if not fitting.any():
+            break
+
+    fitted = p[:, :2]
+    good = fitting & isfinite(p).all(1) & (p[:, 4] > 0) & (p[:, 2] > 0) & \
+           (absolute(fitted - centers) <= radius).all(1)
+
+    result = centers.copy()
+    result[good] = fitted[good]
+    return result
+
+def refine_centers(frame, labels, n, centers, threshold, method):
+    '''Returns the (n, 2) centers of the n labelled spots found by the given
+    method, one of METHODS. 'centers' are the plain centroids.'''
+    if method == 'centroid':
+        return centers
+    if method not in METHODS:
+        raise ValueError('unknown localization method %r' % (method,))
+
+    centers = weighted_centers(frame, labels, n, threshold)
+    if method == 'gaussian':
+        centers = gaussian_centers(frame, centers)
+    return centers
@@ -0,0 +1,168 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the writer of movies of
+the frames with the tracks drawn on them, for both trackers.
+
+The frames are encoded on a pool of threads while the tracker carries on, and
+written in order by a thread of their own. The format is chosen by the file
+extension:
+
+.tif, .tiff :    One multi-page Tiff file. Each page is deflate compressed
+                 and written as soon as it is ready, so frames are not held
+                 in memory. The pages are built here rather than by PIL, whose
+                 Tiff compression is several times slower and holds up the
+                 other threads.
+.gif :           An animated Gif. The frames are reduced to 256 colours on the
+                 threads, but the file can only be written once all of them
+                 are there, when the writer is closed.
+anything else :  One image file per frame, as name_1.jpg, name_2.jpg and so on.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import os.path
+import zlib
+import struct
+from threading import Thread
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from PIL import Image, TiffImagePlugin
+
+FORMATS = {'.tif': 'tiff', '.tiff': 'tiff', '.gif': 'gif'}
+
+class Movie_Writer:
+    def __init__(self, filename, workers = 2, queue_size = 16, \
+                 level = 1, duration = 100):
+        '''Opens the movie 'filename' for writing. 'workers' is the number of
+        threads encoding frames, and at most queue_size frames wait to be
+        written before Add waits for them. 'level' is the zlib compression
+        level of the Tiff pages, from 0 to 9, and 'duration' the time each
+        frame of a Gif is shown for, in ms.'''
+        self.filename = filename
+        self.base, self.extension = os.path.splitext(filename)
+        self.format = FORMATS.get(self.extension.lower(), 'files')
+        self.level = level
+        self.duration = duration
+        self.count = 0
+        self.error = None
+        self.gif_frames = []
+
+        if self.format == 'tiff':
+            self.file = TiffImagePlugin.AppendingTiffWriter(filename, True)
+
+        self.pool = ThreadPool(workers)
+        self.queue = Queue(queue_size)
+        self.writer = Thread(target = self.Write_pages)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def Add(self, image):
+        '''Queues the PIL image to be encoded and written as the next
+        frame.'''
+        if self.error is not None:
+            raise self.error
+        self.count += 1
+        name = '%s_%d%s' % (self.base, self.count, self.extension)
+        self.queue.put(self.pool.apply_async(encode_page, \
+                       (image, self.format, name, self.level)))
+
+    def __call__(self, index, image):
+        '''Adds the image, so that the writer can be used as the frame_writer
+        of stream_tracks.'''
+        self.Add(image)
+
+    def Write_pages(self):
+        '''Run on the writing thread: writes each encoded frame in the order
+        they were added, until Close.'''
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                page = job.get()
+                if self.error is None:
+                    self.Write_page(page)
+            except Exception, error:
+                self.error = error
+
+    def Write_page(self, page):
+        if self.format == 'tiff':
+            self.file.write(page)
+            self.file.newFrame()
+        elif self.format == 'gif':
+            self.gif_frames.append(page)
+
+    def Close(self):
+        '''Waits for the remaining frames to be written and closes the file.
+        Returns the number of frames written.'''
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.close()
+        self.pool.join()
+
+        if self.format == 'tiff':
+            self.file.close()
+        elif self.format == 'gif' and self.gif_frames and self.error is None:
+            self.gif_frames[0].save(self.filename, save_all = True, \
+                                    append_images = self.gif_frames[1:], \
+                                    duration = self.duration, loop = 0)
+            self.gif_frames = []
+
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+def encode_page(image, kind, filename, level):
+    '''Run on the pool: returns the frame encoded as a Tiff page, reduced to a
+    palette image for a Gif, or saves it to 'filename' for single files.'''
+    if kind == 'tiff':
+        return tiff_page(image, level)
+    elif kind == 'gif':
+        return image.convert('RGB').convert('P', palette = Image.ADAPTIVE)
+    image.save(filename)
+
+def tiff_page(image, level = 1):
+    '''Returns the PIL image as a one page Tiff file, with all of its pixels
+    in one strip compressed by zlib at the given level.'''
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    width, height = image.size
+    samples = len(image.mode)
+
+    data = zlib.compress(image.tobytes(), level)
+    bits_offset = 8 + len(data) + len(data) % 2
+    ifd_offset = bits_offset + 2*samples + (2*samples) % 4
+
+    if samples == 1:
+        bits = struct.pack('<HHIH2x', 258, 3, 1, 8)
+    else:
+        bits = struct.pack('<HHII', 258, 3, samples, bits_offset)
+
+    entries = [struct.pack('<HHII', 256, 4, 1, width),
+               struct.pack('<HHII', 257, 4, 1, height),
+               bits,
+               struct.pack('<HHIH2x', 259, 3, 1, 8),
+               struct.pack('<HHIH2x', 262, 3, 1, 1 if samples == 1 else 2),
+               struct.pack('<HHII', 273, 4, 1, 8),
+               struct.pack('<HHIH2x', 277, 3, 1, samples),
+               struct.pack('<HHII', 278, 4, 1, height),
+               struct.pack('<HHII', 279, 4, 1, len(data)),
+               struct.pack('<HHIH2x', 284, 3, 1, 1)]
+
+    return ''.join(['II*\0', struct.pack('<I', ifd_offset), data,
+                    '\0'*(bits_offset - 8 - len(data)),
+                    struct.pack('<%dH' % samples, *[8]*samples),
+                    '\0'*(ifd_offset - bits_offset - 2*samples),
+                    struct.pack('<H', len(entries))] + entries +
+                   [struct.pack('<I', 0)])
+
+def save_movie(frames, filename, workers = 2):
+    '''Writes the PIL images in 'frames', which may be any iterable, to the
+    movie 'filename'. Returns the number of frames written.'''
+    writer = Movie_Writer(filename, workers)
+    try:
+        for frame in frames:
+            writer.Add(frame)
+    finally:
+        count = writer.Close()
+    return count
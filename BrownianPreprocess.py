@@ -0,0 +1,133 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the background
+correction applied to the frames before the spots are found, for sequences
+with uneven or changing illumination.
+
+Preprocessed_Frames wraps any frame source (see BrownianFrames) and can be
+given to either tracker in its place. Two corrections are available:
+
+temporal :  the mean (or median) of the frames in a window around each frame
+            is subtracted, removing everything that doesn't move, such as
+            dust and uneven illumination.
+local :     the mean of the pixels in a square around each pixel is
+            subtracted. Thresholding the result is the same as thresholding
+            each pixel against the brightness of its surroundings.
+
+After correction the background sits at 'level' (128 by default), so the
+usual threshold slider still applies: a threshold of level - 20 finds pixels
+at least 20 darker than their background.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from threading import Lock
+from scipy import ndimage
+from numpy import zeros, median, float32, float64, uint8, rint
+from PIL import Image
+from BrownianFrames import Frame_Sequence
+
+class Preprocessed_Frames(Frame_Sequence):
+    def __init__(self, source, temporal_window = 0, local_radius = 0, \
+                 level = 128, method = 'mean'):
+        '''Wraps the frame source 'source'. temporal_window is the number of
+        frames averaged for the temporal background (0 for none) and
+        local_radius the half width of the square averaged for the local
+        background (0 for none). 'method' is 'mean', which is kept up to date
+        as the frames are read in order, or 'median', which is more robust
+        to spots that stay still but is recomputed for every frame.'''
+        self.source = source
+        self.length = len(source)
+        self.in_memory = source.in_memory
+        self.temporal_window = temporal_window
+        self.local_radius = local_radius
+        self.level = level
+        self.method = method
+        self.lock = Lock()
+        self.Reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['window_sum'] = None
+        state['window'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def Reset(self):
+        '''Forgets the running sum of the temporal window.'''
+        self.window = None
+        self.window_sum = None
+
+    def Settings(self):
+        return (self.temporal_window, self.local_radius, self.level, \
+                self.method)
+
+    def Window(self, i):
+        '''Returns the first and one past the last frame of the temporal
+        window around frame i.'''
+        half = self.temporal_window/2
+        first = min(max(i - half, 0), \
+                    max(self.length - self.temporal_window, 0))
+        return first, min(first + self.temporal_window, self.length)
+
+    def Frame(self, i):
+        return self.source.Get_array(i).astype(float32)
+
+    def Temporal_background(self, i):
+        '''Returns the temporal background of frame i.'''
+        first, last = self.Window(i)
+
+        if self.method == 'median':
+            return median([self.Frame(k) for k in xrange(first, last)], 0)
+
+        #Slide the running sum along if the window has moved a little,
+        #otherwise start it again.
+        if self.window is not None and self.window[0] <= first <= \
+           self.window[1] <= last:
+            old_first, old_last = self.window
+            for k in xrange(old_first, first):
+                self.window_sum -= self.Frame(k)
+            for k in xrange(old_last, last):
+                self.window_sum += self.Frame(k)
+        else:
+            self.window_sum = zeros(self.source.Get_array(i).shape, float64)
+            for k in xrange(first, last):
+                self.window_sum += self.Frame(k)
+        self.window = (first, last)
+
+        return (self.window_sum/(last - first)).astype(float32)
+
+    def Load_array(self, i):
+        raw = self.source.Get_array(i)
+        frame = raw.astype(float32)
+
+        if self.temporal_window > 1:
+            with self.lock:
+                background = self.Temporal_background(i)
+            frame += self.level - background
+        if self.local_radius > 0:
+            frame += self.level - ndimage.uniform_filter(frame, \
+                        2*self.local_radius + 1, mode = 'nearest')
+
+        if raw.dtype == uint8:
+            return rint(frame).clip(0, 255).astype(uint8)
+        return frame
+
+    def Load_frame(self, i):
+        return Image.fromarray(self.Load_array(i))
+
+    def Load_key(self, i):
+        return '%s:%r' % (self.source.Load_key(i), self.Settings())
+
+def preprocess(source, temporal_window = 0, local_radius = 0, level = 128, \
+               method = 'mean'):
+    '''Returns the frame source with the given background corrections, or
+    the source itself if there are none.'''
+    if temporal_window <= 1 and local_radius <= 0:
+        return source
+    return Preprocessed_Frames(source, temporal_window, local_radius, level, \
+                               method)
@@ -0,0 +1,127 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the timers and counters
+kept by the trackers, to show where the time goes on a sequence.
+
+Each tracker keeps a Profile, which records:
+
+stages :    the time spent in each stage (loading, detection, linking,
+            filtering, rendering and so on) and the number of times each ran.
+counters :  totals such as frames read, pixels scanned, blobs found and cache
+            hits and misses.
+series :    values with one entry per frame, such as the number of blobs found
+            and the number of tracks alive. The report gives their mean and
+            largest values.
+
+Report returns all of this as a dictionary and Save writes it as JSON. A
+Profile may also be given a progress function, which is called as
+progress(stage, done, total, message) as the work goes on. message is None
+except for the messages the trackers used to print, and print_progress prints
+just those.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+import json
+from time import time
+from threading import Lock
+from contextlib import contextmanager
+
+class Profile:
+    def __init__(self, progress = None):
+        '''Starts an empty profile. 'progress', if given, is called as
+        progress(stage, done, total, message) by Progress and Message.'''
+        self.progress = progress
+        self.lock = Lock()
+        self.Clear()
+
+    def Clear(self):
+        self.stages = {}
+        self.counters = {}
+        self.series = {}
+        self.started = time()
+
+    @contextmanager
+    def Stage(self, name):
+        '''Times the code in a with block as part of the stage 'name'.'''
+        start = time()
+        try:
+            yield
+        finally:
+            self.Add_time(name, time() - start)
+
+    def Add_time(self, name, seconds, calls = 1):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + calls)
+
+    def Add(self, name, amount = 1):
+        '''Adds amount to the counter 'name'.'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def Record(self, name, value):
+        '''Adds value to the per frame series 'name'.'''
+        with self.lock:
+            self.series.setdefault(name, []).append(value)
+
+    def Progress(self, stage, done, total):
+        '''Reports that 'done' of 'total' steps of the stage are finished.'''
+        if self.progress is not None:
+            self.progress(stage, done, total, None)
+
+    def Message(self, stage, message):
+        '''Passes a message for the user to the progress function.'''
+        if self.progress is not None:
+            self.progress(stage, None, None, message)
+
+    def Report(self, full_series = False):
+        '''Returns the profile as a dictionary of plain values. The per frame
+        series are summarised by their mean and largest values, and included
+        in full if full_series is True.'''
+        with self.lock:
+            report = {'wall seconds': time() - self.started,
+                      'stages': dict((name, {'seconds': seconds,
+                                             'calls': calls})
+                                     for name, (seconds, calls) in \
+                                     self.stages.items()),
+                      'counters': dict(self.counters),
+                      'series': {}}
+            for name, values in self.series.items():
+                summary = {'mean': sum(values) / float(max(len(values), 1)),
+                           'max': max(values) if values else 0,
+                           'frames': len(values)}
+                if full_series:
+                    summary['values'] = list(values)
+                report['series'][name] = summary
+
+        detect = self.stages.get('detect', (0.0, 0))[0]
+        if detect > 0:
+            report['counters']['frames/s detected'] = \
+                   self.counters.get('frames', 0) / detect
+        return report
+
+    def Save(self, filename, full_series = False):
+        '''Writes the report to 'filename' as JSON.'''
+        report_file = open(filename, 'w')
+        json.dump(self.Report(full_series), report_file, indent = 1, \
+                  sort_keys = True)
+        report_file.close()
+
+    def Summary(self):
+        '''Returns the report as lines of text.'''
+        report = self.Report()
+        lines = ['%-24s %10.3f s %8d calls' % (name, stage['seconds'], \
+                                              stage['calls']) \
+                 for name, stage in sorted(report['stages'].items())]
+        lines += ['%-24s %12.6g' % (name, value) for name, value in \
+                  sorted(report['counters'].items())]
+        lines += ['%-24s %12.6g mean %8d max' % (name, s['mean'], s['max']) \
+                  for name, s in sorted(report['series'].items())]
+        return '\n'.join(lines)
+
+def print_progress(stage, done, total, message):
+    '''A progress function that prints the messages, as the trackers always
+    have, and nothing else.'''
+    if message is not None:
+        print message
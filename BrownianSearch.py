@@ -0,0 +1,228 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the search for a single
+spot in a window around where it was last seen, used by the single spot
+tracker (see BrownianCore), and the drawing of the spots found.
+
+Nothing here needs a window or a plot, so it can be used where Tkinter and
+pylab are not available. SingleBeadBrownianTools gives the same names to the
+Spot Tracker window, along with the plotting.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from numpy import asarray, nonzero, zeros, ndarray, array, hypot, sqrt, \
+     arange, int64
+from BrownianLocalize import refine_centers
+from MultipleBeadBrownian import label_blobs, blob_properties
+
+def frame_window(image, bbox):
+    '''Returns the part of the image bounded by the bbox, clipped to the edges
+    of the image, as a 2D array, along with the (x, y) position of its top left
+    corner. If the image is already an array, the window is a view into it and
+    no pixels are copied.'''
+
+    if isinstance(image, ndarray):
+        (ysize, xsize) = image.shape[:2]
+    else:
+        (xsize, ysize) = image.size
+
+    x0, y0 = max(0, bbox[0]), max(0, bbox[1])
+    x1, y1 = min(xsize, bbox[2]), min(ysize, bbox[3])
+
+    if x1 <= x0 or y1 <= y0:
+        return zeros((0, 0)), (x0, y0)
+    if isinstance(image, ndarray):
+        return image[y0:y1, x0:x1], (x0, y0)
+    return asarray(image.crop((x0, y0, x1, y1))), (x0, y0)
+
+def points_below_threshold(image, threshold, bbox):
+    '''Returns a list of the pixel indicies of all of the pixels in the image
+    bounded by the bbox whose value is below the given threshold.'''
+
+    window, (x0, y0) = frame_window(image, bbox)
+
+    xs, ys = nonzero(window.T < threshold)
+
+    return zip((xs + x0).tolist(), (ys + y0).tolist())
+
+def window_center(image, threshold, bbox, localization = 'centroid'):
+    '''Returns the average position [x, y] of the pixels in the image bounded
+    by the bbox whose value is below the given threshold, or None if there are
+    no such pixels. Equivalent to cluster_center(points_below_threshold(...))
+    without building the list of points. With localization 'weighted' or
+    'gaussian' the position is refined as described in BrownianLocalize.'''
+
+    window, (x0, y0) = frame_window(image, bbox)
+
+    mask = window < threshold
+    ys, xs = nonzero(mask)
+
+    if len(xs) == 0:
+        return None
+
+    center = array([[xs.mean(), ys.mean()]])
+    center = refine_centers(window, mask.astype(int), 1, center, threshold, \
+                            localization)
+
+    return [x0 + center[0, 0], y0 + center[0, 1]]
+
+def window_centers(image, threshold, bboxes, localization = 'centroid'):
+    '''Returns window_center(image, threshold, bbox, localization) for each
+    bbox in the list 'bboxes', found together. With 'centroid' localization,
+    and windows that cover much of the part of the image holding them all,
+    the pixels below the threshold are counted once over that part and the
+    count and position sums of each window are read from running totals.
+    Otherwise each window is found in turn.'''
+    if localization != 'centroid' or len(bboxes) < 2:
+        return [window_center(image, threshold, bbox, localization) \
+                for bbox in bboxes]
+
+    region = [min(b[0] for b in bboxes), min(b[1] for b in bboxes), \
+              max(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+    window, (x0, y0) = frame_window(image, region)
+    height, width = window.shape[:2]
+    if sum((b[2]-b[0])*(b[3]-b[1]) for b in bboxes) < height*width:
+        return [window_center(image, threshold, bbox) for bbox in bboxes]
+
+    #Running totals, with a row and column of zeros before the first.
+    mask = window < threshold
+    totals = []
+    for weights in (1, arange(width), arange(height)[:, None]):
+        total = zeros((height+1, width+1), dtype = int64)
+        total[1:, 1:] = (mask*weights).cumsum(0).cumsum(1)
+        totals.append(total)
+
+    centers = []
+    for bbox in bboxes:
+        x_start, x_stop = [min(max(x - x0, 0), width) for x in bbox[0::2]]
+        y_start, y_stop = [min(max(y - y0, 0), height) for y in bbox[1::2]]
+        n, sum_x, sum_y = [t[y_stop, x_stop] - t[y_start, x_stop] - \
+                           t[y_stop, x_start] + t[y_start, x_start] \
+                           for t in totals]
+        if n == 0:
+            centers.append(None)
+        else:
+            #Measured from the window's own corner, as window_center does.
+            centers.append([x0 + x_start + (sum_x - n*x_start) / float(n), \
+                            y0 + y_start + (sum_y - n*y_start) / float(n)])
+    return centers
+
+def nearest_blob_center(image, threshold, bbox, point, \
+                        localization = 'centroid'):
+    '''Groups the pixels in the image bounded by the bbox whose value is below
+    the given threshold into spots, as the multiple spot tracker does, and
+    returns the center [x, y] of the spot nearest to 'point', or None if there
+    are no such pixels. Unlike window_center, other spots in the window don't
+    pull the result away from the one being followed.'''
+
+    window, (x0, y0) = frame_window(image, bbox)
+
+    labels, n = label_blobs(window < threshold)
+    if n == 0:
+        return None
+
+    centers, areas, bboxes = blob_properties(labels, n)
+    centers = refine_centers(window, labels, n, centers, threshold, \
+                             localization)
+
+    k = hypot(centers[:, 0] + x0 - point[0], \
+              centers[:, 1] + y0 - point[1]).argmin()
+
+    return [x0 + centers[k, 0], y0 + centers[k, 1]]
+
+class Spot_Predictor:
+    def __init__(self, position, max_dist, spread = 3.0, min_radius = 3, \
+                 memory = 0.1):
+        '''Predicts where a diffusing spot will be in the next frame and how
+        far from there it should be looked for. The size of the steps the spot
+        takes, and any steady drift, are estimated as it is tracked, each new
+        step counting for 'memory' of the estimate. The search radius is
+        'spread' times the typical step, growing with the square root of the
+        number of frames since the spot was last seen, and is kept between
+        min_radius and 3*max_dist. Once the spot has been missed, the radius
+        is at least that of the window search, max_dist times the number of
+        frames since it was seen. Until the spot has been seen twice, the
+        radius is max_dist.'''
+        self.position = array(position, dtype = float)
+        self.max_dist = max_dist
+        self.spread = spread
+        self.min_radius = min_radius
+        self.memory = memory
+
+        self.drift = zeros(2)
+        self.mean_square_step = None
+        self.missed = 0
+
+    def Prediction(self):
+        '''Returns the predicted position of the spot in the next frame.'''
+        return self.position + self.drift*(self.missed + 1)
+
+    def Radius(self):
+        '''Returns the half width of the square to search in the next frame.'''
+        if self.mean_square_step is None:
+            return self.max_dist
+        radius = self.spread*sqrt(self.mean_square_step*(self.missed + 1))
+        if self.missed > 0:
+            #After a slow stretch the typical step says little about a
+            #sudden jump, which is a likely reason for the spot to be missed.
+            radius = max(radius, self.max_dist*(self.missed + 1))
+        return int(min(max(radius, self.min_radius), 3*self.max_dist) + 0.5)
+
+    def Search_box(self):
+        '''Returns the bbox to search in the next frame.'''
+        (x, y), r = self.Prediction(), self.Radius()
+        return [int(x+0.5) - r, int(y+0.5) - r, int(x+0.5) + r, int(y+0.5) + r]
+
+    def Found(self, position):
+        '''Records that the spot was found at 'position' in the next frame.'''
+        position = array(position, dtype = float)
+        frames = self.missed + 1
+        step = (position - self.position)/frames
+        square_step = ((position - self.Prediction())**2).sum()/frames
+
+        if self.mean_square_step is None:
+            self.mean_square_step = square_step
+        else:
+            self.mean_square_step += self.memory*(square_step - \
+                                                  self.mean_square_step)
+            self.drift += self.memory*(step - self.drift)
+
+        self.position = position
+        self.missed = 0
+
+    def Missed(self):
+        '''Records that the spot was not found in the next frame.'''
+        self.missed += 1
+
+def draw_point(point, image):
+    '''Returns a copy of the image 'image' with each point in the list 'points'
+    drawn as a red pixel drawn on the image.'''
+
+    image = image.convert('RGB')
+    pix = image.load()
+
+    for x in xrange(max(0, int(point[0]) - 2),\
+                    min(int(point[0]) + 3, image.size[0])):
+        for y in xrange(max(0, int(point[1]) - 2),\
+                    min(int(point[1]) + 3, image.size[1])):
+            pix[x, y] = (255, 0, 0)
+    
+    return image
+
+def draw_points(points, image):
+    '''Returns a copy of the image with each (x, y) point in the list 'points'
+    drawn on it, as draw_point draws one.'''
+
+    image = image.convert('RGB')
+    for point in points:
+        image = draw_point(point, image)
+
+    return image
+
+def cluster_center(points):
+    '''returns the vector average the (x,y) tuples in the list points.'''
+
+    xavg, yavg = array(points, dtype = float).mean(0)
+
+    return [xavg, yavg]
@@ -0,0 +1,253 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the threshold sweep,
+which finds how many spots every threshold would give, from one pass over a
+sample of the frames, and suggests a threshold from it.
+
+The number of spots at every threshold comes from one calculation per frame.
+Pixels darker than a threshold t, joined to their neighbours (as in
+label_blobs), form a graph whose edges each join two pixels and are present
+once t is above the brighter of the two. In a minimum spanning forest of all
+the edges, weighted that way, the edges lighter than t join the spots at
+threshold t into trees. So the number of spots at t is the number of pixels
+below t less the number of those edges, and one spanning forest gives the
+count at every threshold. The graph of a large frame takes a lot of memory, so
+only a central crop of each sampled frame is swept.
+
+Two suggestions are made:
+
+'stable' :  the middle of the longest stretch of thresholds over which the
+            number of spots hardly changes, relative to the number of spots,
+            as the threshold moves a few levels either way. Between the
+            threshold too low to catch every bead and the one so high that
+            noise breaks into spots, the count stays at the number of beads.
+'otsu' :    Otsu's threshold of the pixel histogram, which splits the pixels
+            into two groups as different as possible. It suits frames in which
+            the spots cover much of the frame, and not a few small beads.
+
+Run from the command line, as
+
+    python BrownianThreshold.py data/name.tif
+
+it prints the sweep of the file and both suggestions.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from numpy import arange, bincount, cumsum, zeros, concatenate, maximum, \
+     floor, int64, linspace, unique, argmax, abs as absolute, array
+from argparse import ArgumentParser
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+from MultipleBeadBrownian import frame_array
+from BrownianProfile import Profile
+from BrownianFrames import open_frames
+
+#Number of frames sampled from the sequence.
+SAMPLES = 20
+
+#Largest width and height, in pixels, of the part of a frame swept. Larger
+#frames are cropped about their centre.
+SWEEP_SIZE = 512
+
+#Thresholds that would put more than this fraction of a frame in spots are
+#not considered.
+MAX_FRACTION = 0.5
+
+#Number of levels either side over which the stability of the count is
+#measured.
+WINDOW = 4
+
+#Largest change in the number of spots, as a fraction, over which the count is
+#taken to be stable.
+TOLERANCE = 0.05
+
+def frame_levels(frame):
+    '''Returns the frame as an array of whole, non negative levels, such that
+    a pixel is below an integer threshold exactly when its level is.'''
+    levels = floor(frame_array(frame)).astype(int64)
+    return levels.clip(0, None)
+
+def central_crop(levels, size = SWEEP_SIZE):
+    '''Returns the central part of the 2D array, at most size by size.'''
+    height, width = levels.shape
+    top, left = max((height - size) // 2, 0), max((width - size) // 2, 0)
+    return levels[top:top + size, left:left + size]
+
+def blob_counts(frame, max_level):
+    '''Returns an array 'counts' in which counts[t] is the number of spots
+    label_blobs finds in the frame at threshold t, for t from 0 to
+    max_level.'''
+    levels = frame_levels(frame)
+    height, width = levels.shape
+    index = arange(height*width).reshape(height, width)
+
+    #The pairs of neighbouring pixels: across, down and both diagonals.
+    pairs = [(index[:, :-1], index[:, 1:], levels[:, :-1], levels[:, 1:]),
+             (index[:-1, :], index[1:, :], levels[:-1, :], levels[1:, :]),
+             (index[:-1, :-1], index[1:, 1:], levels[:-1, :-1], levels[1:, 1:]),
+             (index[:-1, 1:], index[1:, :-1], levels[:-1, 1:], levels[1:, :-1])]
+    first = concatenate([a.ravel() for (a, b, u, v) in pairs])
+    second = concatenate([b.ravel() for (a, b, u, v) in pairs])
+    weight = concatenate([maximum(u, v).ravel() for (a, b, u, v) in pairs])
+
+    #Edges present only above max_level never matter. The weights are moved
+    #up by one as the spanning tree ignores edges of weight 0.
+    keep = weight < max_level
+    graph = coo_matrix((weight[keep] + 1.0, (first[keep], second[keep])), \
+                       shape = (height*width, height*width)).tocsr()
+    forest = minimum_spanning_tree(graph)
+    joins = bincount((forest.data - 1).astype(int64), minlength = max_level)
+
+    pixels = bincount(levels.ravel(), minlength = max_level)[:max_level]
+    counts = zeros(max_level + 1, dtype = int64)
+    counts[1:] = cumsum(pixels) - cumsum(joins[:max_level])
+    return counts
+
+def otsu_threshold(histogram):
+    '''Returns the threshold that splits the pixels counted in 'histogram'
+    (one bin per level) into the two groups of greatest between group
+    variance.'''
+    levels = arange(len(histogram))
+    total = float(histogram.sum())
+    below = cumsum(histogram)
+    below_sum = cumsum(histogram*levels)
+    above = total - below
+    valid = (below > 0) & (above > 0)
+    mean_below = below_sum / maximum(below, 1)
+    mean_above = (below_sum[-1] - below_sum) / maximum(above, 1)
+    variance = below*above*(mean_below - mean_above)**2
+    variance[~valid] = -1
+    #Pixels at level k or less are below threshold k+1.
+    return int(argmax(variance)) + 1
+
+class Threshold_Sweep:
+    def __init__(self, frames, samples = SAMPLES, start_frame = 0, \
+                 end_frame = None, max_fraction = MAX_FRACTION, \
+                 profile = None, size = SWEEP_SIZE):
+        '''Samples up to 'samples' frames, evenly spaced from start_frame to
+        end_frame, of the frame source 'frames' and finds the number of spots
+        at every threshold in the central size by size pixels of each.
+        Thresholds that would put more than max_fraction of any sampled frame
+        in spots are left out.
+
+        TS.histogram :  the number of sampled pixels at each level.
+        TS.counts :     (samples, thresholds) array of the number of spots in
+                        each sampled frame at each threshold from 0.
+        TS.indices :    the frames sampled.'''
+        if profile is None:
+            profile = Profile()
+        if end_frame is None:
+            end_frame = len(frames)
+        self.indices = unique(linspace(start_frame, end_frame - 1, \
+                                       samples).astype(int)).tolist()
+
+        histograms, counts = [], []
+        with profile.Stage('threshold sweep'):
+            for k, i in enumerate(self.indices):
+                levels = central_crop(frame_levels(frames.Get_array(i)), size)
+                histogram = bincount(levels.ravel())
+                below = cumsum(histogram)
+                max_level = int((below <= max_fraction*levels.size).sum())
+                histograms.append(histogram)
+                counts.append(blob_counts(levels, max(max_level, 1)))
+                #Counted apart from the frames tracked, as the profile may be
+                #the tracker's.
+                profile.Add('sweep frames')
+                profile.Add('sweep pixels', levels.size)
+                profile.Progress('threshold sweep', k + 1, len(self.indices))
+
+        self.histogram = zeros(max(len(h) for h in histograms), dtype = int64)
+        for h in histograms:
+            self.histogram[:len(h)] += h
+
+        #Only the thresholds reached in every sampled frame are kept.
+        length = min(len(c) for c in counts)
+        self.counts = array([c[:length] for c in counts])
+
+    def Thresholds(self):
+        return arange(self.counts.shape[1])
+
+    def Mean_counts(self):
+        '''Returns the mean number of spots per frame at each threshold.'''
+        return self.counts.mean(0)
+
+    def Mean_areas(self):
+        '''Returns the mean area of a spot, in pixels, at each threshold.'''
+        below = concatenate(([0], cumsum(self.histogram)))[:self.counts.shape[1]]
+        return below*1.0 / maximum(self.counts.sum(0), 1)
+
+    def Stability(self, window = WINDOW):
+        '''Returns the change in the mean number of spots over 'window' levels
+        either side of each threshold, as a fraction of the number of spots.
+        Thresholds too close to either end, or with no spots, get 1.'''
+        counts = self.Mean_counts()
+        stability = zeros(len(counts)) + 1.0
+        for t in xrange(window, len(counts) - window):
+            if counts[t] >= 1:
+                stability[t] = absolute(counts[t + window] - \
+                                        counts[t - window]) / counts[t]
+        return stability
+
+    def Suggest(self, method = 'stable', window = WINDOW, \
+                tolerance = TOLERANCE):
+        '''Returns the suggested threshold, found by 'method', either 'stable'
+        or 'otsu'. For 'stable', thresholds whose Stability is at most
+        'tolerance' count as stable, and the middle of the longest stretch of
+        them is returned.'''
+        if method == 'otsu':
+            return otsu_threshold(self.histogram)
+        elif method != 'stable':
+            raise ValueError('unknown threshold method %r' % (method,))
+
+        stability = self.Stability(window)
+        stable = concatenate(([False], stability <= max(stability.min(), \
+                                                        tolerance), [False]))
+        #The middle of the longest stretch of stable thresholds.
+        edges = (stable[1:] != stable[:-1]).nonzero()[0]
+        starts, ends = edges[::2], edges[1::2]
+        longest = argmax(ends - starts)
+        return int((starts[longest] + ends[longest] - 1) / 2)
+
+    def Report(self):
+        '''Returns a list of (threshold, mean spots per frame, mean spot area,
+        stability) for each threshold.'''
+        return zip(self.Thresholds().tolist(), self.Mean_counts().tolist(), \
+                   self.Mean_areas().tolist(), self.Stability().tolist())
+
+def sweep_thresholds(frames, samples = SAMPLES, start_frame = 0, \
+                     end_frame = None, profile = None):
+    '''Returns a Threshold_Sweep of the frame source, reporting its progress
+    to 'profile', so that it can be run on a Tracking_Worker (see
+    BrownianCore).'''
+    return Threshold_Sweep(frames, samples, start_frame, end_frame, \
+                           profile = profile)
+
+def suggest_threshold(frames, method = 'stable', samples = SAMPLES, \
+                      start_frame = 0, end_frame = None):
+    '''Returns the threshold suggested for the frame source, see
+    Threshold_Sweep.Suggest.'''
+    return Threshold_Sweep(frames, samples, start_frame, \
+                           end_frame).Suggest(method)
+
+def main(argv = None):
+    parser = ArgumentParser(description = 'Prints the number of spots found '
+                            'at each threshold in a sample of the frames of '
+                            'an image sequence, and the threshold '
+                            'suggested.')
+    parser.add_argument('stack', help = 'image sequence file')
+    parser.add_argument('--samples', type = int, default = SAMPLES,
+                        help = 'number of frames sampled')
+    args = parser.parse_args(argv)
+
+    sweep = Threshold_Sweep(open_frames(args.stack), args.samples)
+    print 'threshold   spots/frame   spot area   change'
+    for (t, count, area, change) in sweep.Report():
+        if count > 0:
+            print '%9d %13.1f %11.1f %8.3f' % (t, count, area, change)
+    print 'Suggested threshold: %d (stable), %d (otsu)' % \
+          (sweep.Suggest('stable'), sweep.Suggest('otsu'))
+
+if "__main__" == __name__:
+
+    main()
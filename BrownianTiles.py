@@ -0,0 +1,200 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the detection of spots
+in very large frames, a tile at a time, so that the memory used doesn't grow
+with the size of the sensor.
+
+Labelling a whole frame at once needs an integer label for every pixel, and
+the list of every spot pixel, several times the size of the frame itself.
+tiled_blobs instead thresholds and labels one square tile at a time, into a
+bool and a label buffer of the tile's size, and keeps only the sums for each
+spot in the tile. Frames read from uncompressed Tiff files are memory mapped
+(see BrownianFrames), so even the frame is only read a tile at a time.
+
+Each tile is labelled with a halo of one pixel more to its right and below.
+Any two touching pixels lie in some 2x2 square, which lies in the tile, with
+its halo, of the square's top left pixel. So the halo pixels show which spots
+in neighbouring tiles are joined, and the sums of joined spots are added
+together. The spots, their order and their centers are the same as those
+found by frame_blobs on the whole frame.
+
+The tiles may be spread over several threads. numpy lets go of the
+interpreter while thresholding and summing large arrays, so some of that work
+runs at the same time.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from multiprocessing.pool import ThreadPool
+from numpy import asarray, ndarray, ones, nonzero, bincount, unique, zeros, \
+     concatenate, arange, int64, minimum
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from BrownianLocalize import gaussian_centers, METHODS
+
+#Width and height of the tiles, in pixels.
+TILE_SIZE = 1024
+
+#Frames with more pixels than this are found a tile at a time by frame_blobs
+#(see MultipleBeadBrownian).
+TILED_PIXELS = 4096*4096
+
+#Number of threads the tiles of a frame are spread over.
+TILE_THREADS = 1
+
+#Touching along an edge or a corner, as in label_blobs.
+CONNECTIVITY = ones((3, 3), dtype = bool)
+
+class Tile_Spots:
+    def __init__(self, frame, threshold, y0, x0, size, weighted):
+        '''Labels the spots in the tile of 'frame' with its top left corner at
+        (x0, y0), and its halo, and keeps:
+
+        TS.n :              the number of spots labelled in the tile and halo.
+        TS.area, TS.sum_x, TS.sum_y, TS.sum_value :
+                            the number of pixels, and the sums of their x, y
+                            and values, of each spot, counting only the pixels
+                            in the tile itself.
+        TS.first :          the position, in reading order over the whole
+                            frame, of the first pixel of each spot in the
+                            tile.
+        TS.weight, TS.weight_x, TS.weight_y :
+                            if 'weighted', the sums of threshold minus each
+                            pixel value, and of it times x and y.
+        TS.top, TS.left :   the labels of the tile's first row and column.
+        TS.bottom, TS.right :
+                            the labels of the halo row below and the halo
+                            column to the right, including their corner.'''
+        height, width = frame.shape[:2]
+        y1, x1 = min(y0 + size, height), min(x0 + size, width)
+        self.y0, self.x0, self.y1, self.x1 = y0, x0, y1, x1
+
+        mask = frame[y0:min(y1 + 1, height), x0:min(x1 + 1, width)] < \
+               threshold
+        labels, self.n = ndimage.label(mask, structure = CONNECTIVITY)
+
+        #Copied, so that the tile's labels aren't kept.
+        self.top = labels[0, :x1 - x0].copy()
+        self.left = labels[:y1 - y0, 0].copy()
+        self.bottom = labels[y1 - y0, :].copy() if y1 < height else None
+        self.right = labels[:, x1 - x0].copy() if x1 < width else None
+
+        inside = labels[:y1 - y0, :x1 - x0]
+        ys, xs = nonzero(inside)
+        ids = inside[ys, xs]
+        values = frame[y0 + ys, x0 + xs].astype(float)
+        ys += y0
+        xs += x0
+
+        n = self.n + 1
+        self.area = bincount(ids, minlength = n)
+        self.sum_x = bincount(ids, xs, n)
+        self.sum_y = bincount(ids, ys, n)
+        self.sum_value = bincount(ids, values, n)
+
+        #Pixels come in reading order, which within a tile is that of the
+        #whole frame, so the first of each label is its first pixel.
+        self.first = zeros(n, dtype = int64) + height*width
+        labelled, index = unique(ids, return_index = True)
+        self.first[labelled] = ys[index].astype(int64)*width + xs[index]
+
+        if weighted:
+            weights = threshold - values
+            self.weight = bincount(ids, weights, n)
+            self.weight_x = bincount(ids, weights*xs, n)
+            self.weight_y = bincount(ids, weights*ys, n)
+
+def tile_corners(shape, size):
+    '''Returns the (y0, x0) top left corners of the tiles covering a frame of
+    the given shape, in reading order.'''
+    height, width = shape[:2]
+    return [(y0, x0) for y0 in xrange(0, height, size) \
+            for x0 in xrange(0, width, size)]
+
+def tiled_blobs(frame, threshold, localization = 'centroid', \
+                tile_size = TILE_SIZE, threads = TILE_THREADS):
+    '''Returns (centers, areas, intensities) for the spots found in the 2D
+    array 'frame', as frame_blobs does (see MultipleBeadBrownian), working on
+    tiles of tile_size pixels spread over 'threads' threads.'''
+    if localization not in METHODS:
+        raise ValueError('unknown localization method %r' % (localization,))
+    if not isinstance(frame, ndarray):
+        frame = asarray(frame)
+    height, width = frame.shape[:2]
+    weighted = localization != 'centroid'
+
+    corners = tile_corners(frame.shape, tile_size)
+    def label_tile((y0, x0)):
+        return Tile_Spots(frame, threshold, y0, x0, tile_size, weighted)
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            tiles = pool.map(label_tile, corners)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tiles = map(label_tile, corners)
+
+    #Number the labels of all of the tiles together, 0 for the background.
+    offsets = [0]
+    for tile in tiles:
+        offsets.append(offsets[-1] + tile.n)
+    columns = (width + tile_size - 1) / tile_size
+
+    def numbers(k, labels):
+        return (labels + offsets[k]) * (labels > 0)
+
+    #Join the labels of each halo pixel to those of the tile it belongs to.
+    first, second = [zeros(0, dtype = int)], [zeros(0, dtype = int)]
+    for k, tile in enumerate(tiles):
+        if tile.right is not None:
+            first.append(numbers(k, tile.right[:tile.y1 - tile.y0]))
+            second.append(numbers(k + 1, tiles[k + 1].left))
+        if tile.bottom is not None:
+            first.append(numbers(k, tile.bottom[:tile.x1 - tile.x0]))
+            second.append(numbers(k + columns, tiles[k + columns].top))
+        if tile.right is not None and tile.bottom is not None:
+            first.append(numbers(k, tile.bottom[-1:]))
+            second.append(numbers(k + columns + 1, \
+                                  tiles[k + columns + 1].top[:1]))
+    first, second = concatenate(first), concatenate(second)
+    joined = (first > 0) & (second > 0)
+    graph = coo_matrix((ones(joined.sum()), (first[joined], second[joined])), \
+                       shape = (offsets[-1] + 1,)*2)
+    n, spot = connected_components(graph, directed = False)
+
+    #Add up the sums of each spot over the tiles, leaving out the halos.
+    ids = [spot[offsets[k] + arange(1, tile.n + 1)] \
+           for k, tile in enumerate(tiles)]
+    def total_of(name):
+        total = zeros(n)
+        for k, tile in enumerate(tiles):
+            total += bincount(ids[k], getattr(tile, name)[1:], n)
+        return total
+
+    spot_first = zeros(n, dtype = int64) + height*width
+    for k, tile in enumerate(tiles):
+        minimum.at(spot_first, ids[k], tile.first[1:])
+
+    #The background, numbered 0, has no area, and the spots are put in the
+    #order of their first pixels.
+    spot_area = total_of('area')
+    found = nonzero(spot_area > 0)[0]
+    found = found[spot_first[found].argsort(kind = 'mergesort')]
+
+    areas = spot_area[found].astype(int)
+    centers = zeros((len(found), 2))
+    if weighted:
+        weight = total_of('weight')[found]
+        centers[:, 0] = total_of('weight_x')[found] / weight
+        centers[:, 1] = total_of('weight_y')[found] / weight
+        if localization == 'gaussian':
+            centers = gaussian_centers(frame, centers)
+    else:
+        centers[:, 0] = total_of('sum_x')[found] / areas
+        centers[:, 1] = total_of('sum_y')[found] / areas
+    intensities = total_of('sum_value')[found] / areas
+
+    return [tuple(c) for c in centers.tolist()], areas, intensities
@@ -0,0 +1,204 @@
+'''This program was written for the Brownian motion experiment at the
+University of Toronto. This program is distributed with the hope that it might
+be found useful, but with no warranty, not even the implied warranty of
+usefulness for a specific purpose. This file contains the track table, which
+stores the positions of every tracked spot in a few numpy arrays rather than in
+lists of tuples.
+
+A track table has one row per spot position, with the columns
+
+    track_id :  the number of the track the position belongs to.
+    frame :     the index of the frame the spot was found in.
+    x, y :      the position of the spot in pixels.
+    area :      the number of pixels in the spot (0 if unknown).
+    intensity : the mean value of the pixels in the spot (0 if unknown).
+
+The rows are sorted by track and then by frame, so each track is one slice of
+the arrays.
+
+Author: Donald J Woodbury, University of Toronto'''
+
+from array import array as typed_array
+from numpy import array, asarray, zeros, lexsort, concatenate, diff, \
+     flatnonzero, repeat, load, savez, cumsum, frombuffer, intc, int32, \
+     float32, float64
+
+COLUMNS = ('track_id', 'frame', 'x', 'y', 'area', 'intensity')
+TYPES = (int32, int32, float64, float64, int32, float32)
+
+class Track_Table:
+    def __init__(self, track_id, frame, x, y, area = None, intensity = None):
+        '''Builds a table from one array (or list) per column. The area and
+        intensity columns may be left out.'''
+        n = len(track_id)
+        if area is None:
+            area = zeros(n)
+        if intensity is None:
+            intensity = zeros(n)
+
+        columns = [asarray(c, dtype = t) for c, t in \
+                   zip((track_id, frame, x, y, area, intensity), TYPES)]
+
+        order = lexsort((columns[1], columns[0]))
+        if (diff(order) < 0).any():
+            columns = [c[order] for c in columns]
+
+        (self.track_id, self.frame, self.x, self.y, self.area,
+         self.intensity) = columns
+
+        #Row k of track number t runs from starts[t] to starts[t+1].
+        self.starts = concatenate(([0], flatnonzero(diff(self.track_id)) + 1,
+                                   [n])).astype(int)
+        if n == 0:
+            self.starts = array([0])
+
+    def __len__(self):
+        '''Returns the number of tracks.'''
+        return len(self.starts) - 1
+
+    def Size(self):
+        '''Returns the number of rows, that is spot positions, in the table.'''
+        return len(self.track_id)
+
+    def Columns(self):
+        '''Returns the columns as a dictionary of arrays.'''
+        return dict((name, getattr(self, name)) for name in COLUMNS)
+
+    def Lengths(self):
+        '''Returns the number of positions in each track.'''
+        return diff(self.starts)
+
+    def Ids(self):
+        '''Returns the id of each track, in order.'''
+        return self.track_id[self.starts[:-1]]
+
+    def Track(self, k):
+        '''Returns the columns of the k-th track (counting from 0, not its
+        id) as a dictionary of array views.'''
+        rows = slice(self.starts[k], self.starts[k+1])
+        return dict((name, getattr(self, name)[rows]) for name in COLUMNS)
+
+    def Rows(self, keep):
+        '''Returns a new table holding only the rows where the boolean array
+        'keep' is True.'''
+        return Track_Table(*[getattr(self, name)[keep] for name in COLUMNS])
+
+    def Select(self, keep):
+        '''Returns a new table holding only the tracks where the boolean array
+        'keep', with one entry per track, is True.'''
+        return self.Rows(repeat(asarray(keep, dtype = bool), self.Lengths()))
+
+    def Remove_short_tracks(self, min_length = 3):
+        '''Returns a new table without the tracks that have fewer than
+        min_length positions.'''
+        return self.Select(self.Lengths() >= min_length)
+
+    def Frames(self, first, last):
+        '''Returns a new table holding only the rows from the frames first to
+        last, including first but not last.'''
+        return self.Rows((self.frame >= first) & (self.frame < last))
+
+    def Save(self, filename):
+        '''Saves the table to a numpy .npz file, see load_tracks.'''
+        savez(filename, **self.Columns())
+
+def load_tracks(filename):
+    '''Returns the track table saved to 'filename' by Track_Table.Save.'''
+    data = load(filename)
+    return Track_Table(*[data[name] for name in COLUMNS])
+
+def table_from_tracks(tracks, areas = None, intensities = None):
+    '''Returns a track table holding the tracks in the list 'tracks', each a
+    list of (index, (x, y)) tuples as in Multiple_Spot_Track.tracks. Track k is
+    given the id k. 'areas' and 'intensities', if given, are lists of lists
+    with one value for each position in each track.'''
+    lengths = [len(track) for track in tracks]
+    rows = [(index, x, y) for track in tracks for (index, (x, y)) in track]
+    if len(rows) == 0:
+        rows = zeros((0, 3))
+
+    rows = array(rows, dtype = float64)
+    track_id = repeat(range(len(tracks)), lengths)
+
+    if areas is not None:
+        areas = [a for track in areas for a in track]
+    if intensities is not None:
+        intensities = [v for track in intensities for v in track]
+
+    return Track_Table(track_id, rows[:, 0], rows[:, 1], rows[:, 2], areas,
+                       intensities)
+
+class Track_Rows:
+    def __init__(self):
+        '''Collects the rows of a track table one at a time, as the spots are
+        linked, in compact typed arrays rather than lists of tuples. Each row
+        names its spot by its frame and its place among the spots found in
+        that frame, so the position, area and intensity of the spot are only
+        looked up when the table is built.'''
+        self.track_id = typed_array('i')
+        self.frame = typed_array('i')
+        self.spot = typed_array('i')
+
+    def __len__(self):
+        return len(self.track_id)
+
+    def Add(self, number, index, spot):
+        '''Adds the spot numbered 'spot' in frame 'index' to track 'number'.'''
+        self.track_id.append(number)
+        self.frame.append(index)
+        self.spot.append(spot)
+
+    def Column(self, name):
+        '''Returns the column 'name' as a numpy array.'''
+        column = getattr(self, name)
+        if len(column) == 0:
+            return zeros(0, dtype = int)
+        return frombuffer(column, dtype = intc)
+
+    def Table(self, centers, areas, intensities, first_frame = 0):
+        '''Returns the rows as a Track_Table. centers[f], areas[f] and
+        intensities[f] list the (x, y), area and intensity of each spot found
+        in frame first_frame + f.'''
+        counts = [len(frame_centers) for frame_centers in centers]
+        offsets = concatenate(([0], cumsum(counts)[:-1])).astype(int)
+        rows = offsets[self.Column('frame') - first_frame] + \
+               self.Column('spot')
+
+        xy = array([center for frame_centers in centers \
+                    for center in frame_centers], dtype = float64)
+        xy = xy.reshape((-1, 2))
+        area = concatenate([zeros(0)] + [asarray(a, dtype = float64) \
+                                         for a in areas])
+        intensity = concatenate([zeros(0)] + \
+                                [asarray(v, dtype = float64) \
+                                 for v in intensities])
+
+        return Track_Table(self.Column('track_id'), self.Column('frame'), \
+                           xy[rows, 0], xy[rows, 1], area[rows], \
+                           intensity[rows])
+
+class Track_List:
+    def __init__(self, table):
+        '''A read only list of tracks, each a list of (index, (x, y)) tuples,
+        built from the track table as each one is asked for. This is the form
+        of Multiple_Spot_Track.tracks.'''
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[j] for j in xrange(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('track index out of range')
+
+        track = self.table.Track(k)
+        return zip(track['frame'].tolist(),
+                   zip(track['x'].tolist(), track['y'].tolist()))
+
+    def __iter__(self):
+        for k in xrange(len(self)):
+            yield self[k]
@@ -8,16 +8,47 @@ intended for use with the supporting Tools file.
 
 Author: Donald J Woodbury, University of Toronto'''
 
-from Tkinter import *
-from tkFileDialog import asksaveasfilename, askopenfilename
 from math import sqrt
-from PIL import Image, ImageDraw, ImageTk, ImageSequence, ImageOps
+from time import time
+from PIL import Image, ImageDraw, ImageSequence, ImageOps
 from scipy.misc import fromimage
-from numpy import array, nonzero, zeros, arange, swapaxes, argwhere
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from multiprocessing import Pool
+from BrownianFrames import open_frames, as_frame_sequence, Shared_Frames
+from BrownianTracks import Track_List, Track_Rows
+from BrownianLocalize import refine_centers
+from BrownianPreprocess import preprocess
+from BrownianExport import export_tracks
+from BrownianMovie import save_movie
+from BrownianProfile import Profile
+from BrownianTiles import tiled_blobs, TILED_PIXELS
+from numpy import array, nonzero, zeros, arange, swapaxes, argwhere, ones, \
+     asarray, bincount, unique, argsort, repeat, concatenate, ndarray, full, \
+     searchsorted
+
+#Two pixels belong to the same spot if they touch along an edge or a corner,
+#the same rule used by group_points.
+CONNECTIVITY = ones((3, 3), dtype = bool)
+
+#Least number of frames before its own that each time chunk is linked from,
+#so that its tracks have settled by the time they are stitched on.
+CHUNK_OVERLAP = 16
+
+#Number of colours that the tracks drawn by stream_tracks, whose number isn't
+#known until the end, take in turn.
+STREAM_COLOURS = 32
 
 class Multiple_Spot_Track:
     def __init__(self, max_frames = 3, max_dist = 40, threshold = 128, \
-                 start_frame = 0, end_frame = None, im_seq = None):
+                 start_frame = 0, end_frame = None, im_seq = None, \
+                 processes = 1, chunk_size = 16, linking = 'nearest', \
+                 localization = 'centroid', cache = None, \
+                 temporal_window = 0, local_radius = 0, profile = None, \
+                 time_chunk = None):
         '''Prompts the user to select an image sequence file and the performs
         a multiple bead spot tracking algorithm on the images therein. There
         are two objects meant to be accesed by the user:
@@ -33,6 +64,10 @@ class Multiple_Spot_Track:
                         (index, (x_location, y_location)), indicating the
                         location of that spot in each frame.
 
+        MST.table :     The same tracks as a Track_Table (see BrownianTracks),
+                        which also holds the area and intensity of each spot.
+                        MST.tracks is a view of this table.
+
         To make these two objects more usable, the user is provided with a few
         useful methods that can either save, or display MST.frames.
 
@@ -56,13 +91,56 @@ class Multiple_Spot_Track:
                         sequence to be analysed.
 
         end_frame :     Integer, the index of the last image in the image
-                        sequence to be analysed.'''
+                        sequence to be analysed.
 
-        #Opening the Image Sequence
+        processes :     Integer, the number of worker processes used to find
+                        the spots. None uses one per processor, 1 finds the
+                        spots in this process.
+
+        chunk_size :    Integer, the number of frames handed to a worker
+                        process at a time.
+
+        linking :       'nearest' joins each track to the nearest free spot,
+                        closest pairs first. 'optimal' chooses the joins that
+                        give the smallest total distance moved.
+
+        localization :  The method used to find the center of each spot, one
+                        of 'centroid', 'weighted' or 'gaussian' (see
+                        BrownianLocalize).
 
-        self.im_seq = im_seq
+        cache :         A Detection_Cache (see BrownianCache) in which the spots
+                        found in each frame are kept, so that tracking the
+                        same frames again with other max_frames, max_dist or
+                        linking settings doesn't find the spots again.
+
+        temporal_window, local_radius :
+                        Background corrections applied to the frames before
+                        the spots are found, see BrownianPreprocess. 0 for
+                        none.
+
+        profile :       A Profile (see BrownianProfile) in which the time
+                        taken by each stage, and counts such as the blobs
+                        found, are recorded. MST.profile holds a new one if
+                        none is given.
+
+        time_chunk :    Integer. If given, the frames are split into chunks of
+                        this many frames, which are tracked at the same time
+                        by the worker processes and stitched together (see
+                        Track_in_chunks). The tracks are the same as those
+                        found in one pass.'''
+
+        if profile is None:
+            profile = Profile()
+        self.profile = profile
+
+        #Opening the Image Sequence
+        start = time()
 
         if im_seq == None:
+            #Imported here so that the tracker can run without a display.
+            from Tkinter import Tk
+            from tkFileDialog import askopenfilename
+
             root = Tk()
             filename = askopenfilename(master = root,
                                        filetypes = [('Tiff','*.tif'), \
@@ -70,20 +148,27 @@ class Multiple_Spot_Track:
                                        title="Open...")
             root.destroy()
 
-            im_seq = Image.open(filename)
-            self.im_seq = []
-            i = 0
-            for frame in ImageSequence.Iterator(im_seq):
-                im = ImageSequence.Iterator(im_seq)[i]
-                self.im_seq.append(ImageSequence.Iterator(im_seq)[i].copy())
-                i += 1
+            self.im_seq = open_frames(filename)
+        else:
+            self.im_seq = as_frame_sequence(im_seq)
+
+        self.im_seq = preprocess(self.im_seq, temporal_window, local_radius)
 
         #Parameters
         self.im_size = self.im_seq[0].size
+        self.profile.Add_time('load', time() - start)
 
         self.threshold = threshold
+        self.processes = processes
+        self.chunk_size = chunk_size
         self.max_frames = max_frames
         self.max_distance = max_dist
+        self.linking = linking
+        self.localization = localization
+        self.cache = cache
+        self.temporal_window = temporal_window
+        self.local_radius = local_radius
+        self.time_chunk = time_chunk
 
         self.start_frame = start_frame
         if end_frame == None:
@@ -96,8 +181,11 @@ class Multiple_Spot_Track:
         self.frames = []
         self.tracks = []
 
-        self.Find_spots()
-        self.Track_spots()
+        if self.time_chunk:
+            self.Track_in_chunks()
+        else:
+            self.Find_spots()
+            self.Track_spots()
         self.Eliminate_short_tracks()
 
     #___________________Analysis__________________#
@@ -107,61 +195,554 @@ class Multiple_Spot_Track:
         defined in a list of lists, each sublist containing all spots found
         in a given frame.'''
 
-        self.spots = []
-        for frame in self.im_seq[self.start_frame:self.end_frame]:
+        start = time()
+        indices = range(self.start_frame, self.end_frame)
+        settings = (self.threshold, self.localization)
+
+        blobs = [None]*len(indices)
+        if self.cache is not None:
+            keys = [self.im_seq.Frame_key(i) for i in indices]
+            blobs = [self.cache.Get(key, settings) for key in keys]
+        missing = [k for k in xrange(len(indices)) if blobs[k] is None]
+
+        if self.processes != 1:
+            found = parallel_find_spots(self.im_seq, \
+                                        [indices[k] for k in missing], \
+                                        self.threshold, self.processes, \
+                                        self.chunk_size, self.localization, \
+                                        self.profile)
+        else:
+            found = []
+            for k in missing:
+
+                frame = self.im_seq.Get_array(indices[k])
+                found.append(frame_blobs(frame, self.threshold, \
+                                         self.localization))
+                self.profile.Progress('detect', len(found), len(missing))
 
-            points = threshold2(frame, self.threshold)
-            grouped_points = group_points(points)
-            centers = center_of_clusters(grouped_points)
+        for k, frame_found in zip(missing, found):
+            blobs[k] = frame_found
+            if self.cache is not None:
+                self.cache.Put(keys[k], settings, frame_found)
 
-            self.spots.append(centers)
+        self.spots = [centers for (centers, areas, intensities) in blobs]
+        self.spot_areas = [areas for (centers, areas, intensities) in blobs]
+        self.spot_intensities = [intensities for (centers, areas, intensities) \
+                                 in blobs]
+
+        width, height = self.im_size
+        self.profile.Add('frames', len(missing))
+        self.profile.Add('pixels scanned', len(missing)*width*height)
+        if self.cache is not None:
+            self.profile.Add('cache hits', len(indices) - len(missing))
+            self.profile.Add('cache misses', len(missing))
+        for centers in self.spots:
+            self.profile.Record('blobs', len(centers))
+        self.profile.Add_time('detect', time() - start)
 
     def Track_spots(self):
         '''Takes the information about the location of the spots from the
         Find_spots method and relates the information about the spots to yeild
         the tracks of each individual spot, defined in the list of lists
-        self.tracks.'''
+        self.tracks. The rows of the tracks are kept as the spots are linked,
+        rather than the tracks themselves (see Track_Rows).'''
         
+        start = time()
+        self.rows = Track_Rows()
+        linker = Spot_Linker(self.max_frames, self.max_distance, self.linking, \
+                             record = self.rows.Add, keep_tracks = False)
+
         i = self.start_frame
         for centers in self.spots:
-            for track in self.tracks:
-                
-                [index, (x0, y0)] = track[-1]
-                if index > i-1 or index < i-(self.max_frames+1):
-                    continue
-                
-                j = 0
-                for (x1,y1) in centers:
-                    if distance((x1,y1), (x0, y0)) < self.max_distance:
-                        track.append((i, (x1,y1)))
-                        del centers[j]
-                        break
-                    j+=1
-
-            for center in centers:
-                self.tracks.append([(i, center)])
+            linker.Add_frame(i, centers)
+            self.profile.Record('tracks alive', len(linker.active))
+            self.profile.Progress('link', i - self.start_frame + 1, \
+                                  len(self.spots))
+            i += 1
+
+        self.Build_table()
+        self.profile.Add_time('link', time() - start)
+
+    def Build_table(self):
+        '''Builds self.table, and self.tracks as a view of it, from the rows
+        in self.rows and the spots found in each frame.'''
+        self.table = self.rows.Table(self.spots, self.spot_areas, \
+                                     self.spot_intensities, self.start_frame)
+        self.rows = None
+        self.tracks = Track_List(self.table)
+
+    def Track_in_chunks(self):
+        '''Finds and links the spots in chunks of time_chunk frames at once,
+        each on a worker process (see track_time_chunk), in place of
+        Find_spots and Track_spots.
+
+        Each chunk is linked from CHUNK_OVERLAP frames before its first, or
+        more for a large max_frames, so that by its first frame it is most
+        likely following the same tracks, from the same positions, as the
+        chunks before it. The chunks are then stitched on in order: once the
+        live tracks of a chunk, after some frame, end at the same frames and
+        positions as the live tracks found so far, linking goes on from there
+        in the same way in both, so the rest of the chunk's tracks are
+        adopted as they are. Until then, its frames are linked again here.
+        Since Spot_Linker's joins depend only on the last entries of the live
+        tracks, and not on their order, this gives the tracks of
+        Track_spots.'''
+        start = time()
+        overlap = max(CHUNK_OVERLAP, 2*(self.max_frames + 1))
+        frames, offset = self.im_seq, 0
+        if self.processes != 1 and frames.in_memory:
+            frames = Shared_Frames(frames, range(self.start_frame, \
+                                                 self.end_frame))
+            offset = self.start_frame
+
+        jobs = [(max(first - overlap, self.start_frame), first, \
+                 min(first + self.time_chunk, self.end_frame), offset, \
+                 self.threshold, self.localization, self.max_frames, \
+                 self.max_distance, self.linking, overlap) \
+                for first in xrange(self.start_frame, self.end_frame, \
+                                    self.time_chunk)]
+
+        self.spots, self.spot_areas, self.spot_intensities = [], [], []
+        self.rows = Track_Rows()
+        linker = Spot_Linker(self.max_frames, self.max_distance, self.linking, \
+                             record = self.rows.Add, keep_tracks = False)
+
+        if self.processes == 1:
+            pool = None
+            results = (track_time_chunk(frames, job) for job in jobs)
+        else:
+            pool = Pool(self.processes, initializer = init_worker, \
+                        initargs = (frames,))
+            results = pool.imap(track_chunk_in_worker, jobs)
+        try:
+            for result in results:
+                self.Stitch_chunk(linker, result)
+                self.profile.Progress('track', len(self.spots), \
+                                      self.end_frame - self.start_frame)
+        except:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            raise
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        width, height = self.im_size
+        self.profile.Add('frames', len(self.spots))
+        self.profile.Add('pixels scanned', len(self.spots)*width*height)
+        if self.cache is not None:
+            settings = (self.threshold, self.localization)
+            for k, blobs in enumerate(zip(self.spots, self.spot_areas, \
+                                          self.spot_intensities)):
+                self.cache.Put(self.im_seq.Frame_key(self.start_frame + k), \
+                               settings, blobs)
+        for centers in self.spots:
+            self.profile.Record('blobs', len(centers))
+
+        self.Build_table()
+        self.profile.Add_time('track', time() - start)
 
+    def Stitch_chunk(self, linker, (first, last, blobs, tracks, spots, states, \
+                                    active)):
+        '''Adds the spots and tracks found by track_time_chunk in frames
+        first to last-1 to those found so far, recording their rows in
+        self.rows. 'linker' is the Spot_Linker holding the live tracks found
+        so far, each with only its last entry, and is left holding them at the
+        end of the chunk.'''
+        centers = [found[0] for found in blobs]
+        self.spots.extend(centers)
+        self.spot_areas.extend([found[1] for found in blobs])
+        self.spot_intensities.extend([found[2] for found in blobs])
+
+        #Link here until the live tracks match those of the chunk.
+        i = first - 1
+        while True:
+            live = dict(((track[-1][0], track[-1][1]), track) \
+                        for track in linker.active)
+            state = states.get(i)
+            if state is not None and len(state) == len(live) and \
+               all(end in live for (n, end) in state):
+                break
+            if i == last - 1:
+                return
             i += 1
+            linker.Add_frame(i, centers[i - first])
+            self.profile.Add('frames relinked')
+
+        #Carry on the live tracks, and adopt those begun after frame i, in
+        #the order they began.
+        order = dict((id(track), k) for k, track in enumerate(linker.active))
+        joined = dict((n, live[end]) for (n, end) in state)
+        active = set(active)
+        for n, track in enumerate(tracks):
+            if n in joined:
+                number = linker.Number(joined[n])
+            elif track[0][0] > i:
+                number = linker.Begin()
+                joined[n] = [track[-1]]
+                if n in active:
+                    linker.Adopt(joined[n], number)
+            else:
+                continue
+            for (entry, spot) in zip(track, spots[n]):
+                if entry[0] > i:
+                    self.rows.Add(number, entry[0], spot)
+            joined[n][-1] = track[-1]
+
+        #Live tracks are kept in the order they began.
+        linker.active = [joined[n] for n in sorted(active, key = lambda n: \
+                         (0, order[id(joined[n])]) if id(joined[n]) in order \
+                         else (1, n))]
+        linker.numbers = dict((id(track), linker.Number(track)) \
+                              for track in linker.active)
 
     def Eliminate_short_tracks(self):
         '''Removes all elements in self.tracks that have two or less entries.
         ensures that short blips in the images are not considered.'''
-        k = 0         
-        while k < len(self.tracks):
-            if len(self.tracks[k]) < 3:
-                del self.tracks[k]
-                k -= 1
-            k+=1
+        start = time()
+        n = len(self.table)
+        self.table = self.table.Remove_short_tracks(3)
+        self.tracks = Track_List(self.table)
+        self.profile.Add('short tracks removed', n - len(self.table))
+        self.profile.Add('tracks', len(self.table))
+        self.profile.Add_time('filter', time() - start)
             
     def Draw_track(self):
         '''Draws the track of each spot on the images and returns them on the
         list self.frames.'''
+        start = time()
+        renderer = Track_Renderer(self.table, self.im_size)
         for i in xrange(self.start_frame, self.end_frame):
-            frame = draw_chain(self.tracks, self.im_seq[i], i)
+            frame = renderer.Render(self.im_seq[i], i)
             self.frames.append(frame)
+            self.profile.Progress('render', i - self.start_frame + 1, \
+                                  self.end_frame - self.start_frame)
+        self.profile.Add_time('render', time() - start)
 
         return self.frames
 
+    def Save_movie(self, filename, workers = 2):
+        '''Draws the track of each spot on the images and writes them to the
+        movie 'filename' (see BrownianMovie), without keeping them in
+        self.frames. The frames are encoded on 'workers' threads while the
+        next ones are drawn. Returns the number of frames written.'''
+        with self.profile.Stage('movie'):
+            renderer = Track_Renderer(self.table, self.im_size)
+            return save_movie((renderer.Render(self.im_seq[i], i) \
+                               for i in xrange(self.start_frame, \
+                                               self.end_frame)), \
+                              filename, workers)
+
+    def Parameters(self):
+        '''Returns the tracking parameters as a dictionary.'''
+        return {'threshold': self.threshold,
+                'max_frames': self.max_frames,
+                'max_dist': self.max_distance,
+                'linking': self.linking,
+                'localization': self.localization,
+                'temporal_window': self.temporal_window,
+                'local_radius': self.local_radius,
+                'start_frame': self.start_frame,
+                'end_frame': self.end_frame}
+
+    def Save_tracks(self, filename, frame_rate = None, source = None):
+        '''Saves all of the tracks, with the tracking parameters, to a track
+        file in the format given by its extension (see BrownianExport).
+        Returns the number of tracks saved.'''
+        metadata = {'parameters': self.Parameters(),
+                    'frame interval': frame_rate,
+                    'frame size': list(self.im_size),
+                    'source': source}
+        with self.profile.Stage('save'):
+            return export_tracks(self.table, filename, metadata)
+
+class Spot_Linker:
+    def __init__(self, max_frames = 3, max_dist = 40, linking = 'nearest', \
+                 record = None, keep_tracks = True):
+        '''Joins the spots found in each frame, given one frame at a time, onto
+        the tracks that are still live. A track is live until it has not been
+        seen for more than max_frames frames. The parameters are those of
+        Multiple_Spot_Track.
+
+        The tracks are numbered from 0 in the order they begin. If 'record'
+        is given, it is called as record(number, index, j) for each spot
+        added to a track, where j is the spot's place in the centers of frame
+        'index'. If keep_tracks is False, each track holds only its last
+        entry, for a caller that keeps the rows given to 'record' instead.'''
+        self.max_frames = max_frames
+        self.max_distance = max_dist
+        self.linking = linking
+        self.record = record
+        self.keep_tracks = keep_tracks
+        self.active = []
+        self.numbers = {}
+        self.begun = 0
+
+    def Number(self, track):
+        '''Returns the number of the live track.'''
+        return self.numbers[id(track)]
+
+    def Begin(self):
+        '''Returns the number of the next track to begin.'''
+        self.begun += 1
+        return self.begun - 1
+
+    def Adopt(self, track, number):
+        '''Gives the track, begun elsewhere, its number. The caller makes it
+        live.'''
+        self.numbers[id(track)] = number
+
+    def Add_entry(self, track, entry, j):
+        if self.keep_tracks:
+            track.append(entry)
+        else:
+            track[-1] = entry
+        if self.record is not None:
+            self.record(self.numbers[id(track)], entry[0], j)
+
+    def Add_frame(self, index, centers):
+        '''Links the spot centers found in frame 'index' to the live tracks.
+        Returns (ended, started): the tracks that can no longer continue, and
+        the new tracks begun by spots that joined no track.'''
+
+        ended = [track for track in self.active \
+                 if track[-1][0] < index-(self.max_frames+1)]
+        self.active = [track for track in self.active \
+                       if track[-1][0] >= index-(self.max_frames+1)]
+        for track in ended:
+            del self.numbers[id(track)]
+
+        #The tracks are offered to link_spots in order of their last entries,
+        #so that the joins don't depend on the order the tracks are held in
+        #when two are exactly as good.
+        ends = [track[-1] for track in self.active]
+        order = sorted(xrange(len(ends)), key = lambda k: (ends[k][1], \
+                                                           ends[k][0]))
+        joins = link_spots([ends[k][1] for k in order], centers, \
+                           self.max_distance, self.linking)
+
+        joined = set()
+        for (k, j) in joins:
+            self.Add_entry(self.active[order[k]], (index, centers[j]), j)
+            joined.add(j)
+
+        started = []
+        for j in xrange(len(centers)):
+            if j not in joined:
+                track = [(index, centers[j])]
+                self.Adopt(track, self.Begin())
+                if self.record is not None:
+                    self.record(self.Number(track), index, j)
+                started.append(track)
+        self.active.extend(started)
+
+        return ended, started
+
+    def Finish(self):
+        '''Ends and returns all of the live tracks.'''
+        ended = self.active
+        self.active = []
+        self.numbers = {}
+        return ended
+
+def stream_tracks(im_seq, threshold = 128, max_dist = 40, max_frames = 3, \
+                  start_frame = 0, end_frame = None, linking = 'nearest', \
+                  min_length = 3, frame_writer = None, \
+                  localization = 'centroid', cache = None, \
+                  temporal_window = 0, local_radius = 0, profile = None):
+    '''A generator that finds and links the spots one frame at a time, in the
+    same way as Multiple_Spot_Track, and yields each track as soon as it ends.
+    Tracks with fewer than min_length entries are dropped, as in
+    Eliminate_short_tracks. Only the live tracks and the current frame are held
+    in memory, so the length of the sequence doesn't matter.
+
+    If frame_writer is given, it is called as frame_writer(index, image) with
+    each frame as it is processed, with the tracks drawn on it so far, each
+    keeping the colour it was given when it began (see Stream_Renderer). If a
+    Detection_Cache is given, spots are taken from it where possible.
+    temporal_window and local_radius are the background corrections of
+    BrownianPreprocess. If a Profile (see BrownianProfile) is given, the time
+    taken by each stage and the counts of Multiple_Spot_Track are recorded in
+    it.'''
+    if profile is None:
+        profile = Profile()
+
+    with profile.Stage('load'):
+        frames = preprocess(as_frame_sequence(im_seq), temporal_window, \
+                            local_radius)
+        if end_frame == None:
+            end_frame = len(frames)
+
+    linker = Spot_Linker(max_frames, max_dist, linking)
+    colours = {}
+    begun = 0
+    renderer = None
+
+    for i in xrange(start_frame, end_frame):
+        with profile.Stage('detect'):
+            blobs = None
+            if cache is not None:
+                key = frames.Frame_key(i)
+                blobs = cache.Get(key, (threshold, localization))
+                profile.Add('cache hits' if blobs is not None else \
+                            'cache misses')
+            if blobs is None:
+                pixels = frames.Get_array(i)
+                blobs = frame_blobs(pixels, threshold, localization)
+                profile.Add('frames')
+                profile.Add('pixels scanned', pixels.size)
+                if cache is not None:
+                    cache.Put(key, (threshold, localization), blobs)
+
+        with profile.Stage('link'):
+            centers = blobs[0]
+            ended, started = linker.Add_frame(i, centers)
+        profile.Record('blobs', len(centers))
+        profile.Record('tracks alive', len(linker.active))
+
+        if frame_writer is not None:
+            #By the order the tracks began, not their place among the live
+            #tracks, which changes as the tracks before them end.
+            for track in started:
+                colours[id(track)] = chain_colour(begun % STREAM_COLOURS, \
+                                                  STREAM_COLOURS)
+                begun += 1
+            for track in ended:
+                del colours[id(track)]
+            with profile.Stage('render'):
+                image = frames[i]
+                if renderer is None:
+                    renderer = Stream_Renderer(image.size)
+                frame_writer(i, renderer.Render(image, i, linker.active, \
+                                                [colours[id(track)] for track \
+                                                 in linker.active]))
+
+        profile.Progress('track', i - start_frame + 1, end_frame - start_frame)
+
+        for track in ended:
+            if len(track) >= min_length:
+                profile.Add('tracks')
+                yield track
+            else:
+                profile.Add('short tracks removed')
+
+    for track in linker.Finish():
+        if len(track) >= min_length:
+            profile.Add('tracks')
+            yield track
+        else:
+            profile.Add('short tracks removed')
+
+class Stream_Renderer:
+    def __init__(self, size):
+        '''Draws the live tracks of stream_tracks onto frames of the given
+        size, one frame at a time in order. As in Track_Renderer, the trails
+        are kept on a layer of their own and each frame only adds the newest
+        segment of each track, so the time taken doesn't grow with the length
+        of the tracks. Trails stay on the layer after their tracks end.'''
+        self.layer = Image.new('RGB', size)
+        self.mask = Image.new('L', size)
+        self.draw_layer = ImageDraw.Draw(self.layer)
+        self.draw_mask = ImageDraw.Draw(self.mask)
+
+    def Render(self, image, index, tracks, colours):
+        '''Returns an RGB copy of the image with the trails drawn, after adding
+        the segment of each of the live tracks that ends in frame 'index', in
+        the colour given for it in the list 'colours'.'''
+        for (track, colour) in zip(tracks, colours):
+            if track[-1][0] == index and len(track) > 1:
+                line = [track[-2][1], track[-1][1]]
+                self.draw_layer.line(line, fill = colour)
+                self.draw_mask.line(line, fill = 255)
+
+        im = image.convert('RGB')
+        im.paste(self.layer, (0, 0), self.mask)
+
+        draw = ImageDraw.Draw(im)
+        d = 2
+        for (track, colour) in zip(tracks, colours):
+            if track[-1][0] == index:
+                x, y = track[-1][1]
+                draw.rectangle((x-d, y-d, x+d, y+d), fill = colour)
+
+        return im
+
+class Track_Renderer:
+    def __init__(self, table, size):
+        '''Draws the tracks in the track table onto frames of the given size,
+        in the same way as draw_chain. The trails are kept on a layer of their
+        own, and each call to Render only adds the segments that end in the
+        new frames, so rendering a whole sequence in order takes time in
+        proportion to the number of positions rather than frames times
+        positions.'''
+        self.table = table
+        self.size = size
+
+        n = len(table)
+        k = arange(n)
+        self.colours = zip((255-(255*k)/max(n, 1)).tolist(), [0]*n, \
+                           ((255*k)/max(n, 1)).tolist())
+
+        #The track of each row, and whether it continues from the row before.
+        self.row_track = repeat(k, table.Lengths())
+        self.continues = ones(table.Size(), dtype = bool)
+        self.continues[table.starts[:-1]] = False
+
+        self.by_frame = argsort(table.frame, kind = 'mergesort')
+        self.frames = table.frame[self.by_frame]
+
+        self.Reset()
+
+    def Reset(self):
+        '''Clears the trail layer.'''
+        self.layer = Image.new('RGB', self.size)
+        self.mask = Image.new('L', self.size)
+        self.draw_layer = ImageDraw.Draw(self.layer)
+        self.draw_mask = ImageDraw.Draw(self.mask)
+        self.drawn_until = None
+
+    def Rows(self, first, last):
+        '''Returns the rows of the table in the frames first to last, including
+        both.'''
+        start = searchsorted(self.frames, first, side = 'left')
+        stop = searchsorted(self.frames, last, side = 'right')
+        return self.by_frame[start:stop]
+
+    def Draw_segments(self, first, last):
+        '''Adds to the trail layer each segment that ends in the frames first
+        to last.'''
+        x, y = self.table.x, self.table.y
+        for r in self.Rows(first, last):
+            if self.continues[r]:
+                line = [(x[r-1], y[r-1]), (x[r], y[r])]
+                self.draw_layer.line(line, fill = \
+                                     self.colours[self.row_track[r]])
+                self.draw_mask.line(line, fill = 255)
+
+    def Render(self, image, index):
+        '''Returns an RGB copy of the image with the tracks drawn up to the
+        given index. Rendering is fastest when called with increasing
+        indices.'''
+        if self.drawn_until is None or index < self.drawn_until:
+            self.Reset()
+            self.Draw_segments(0, index)
+        elif index > self.drawn_until:
+            self.Draw_segments(self.drawn_until+1, index)
+        self.drawn_until = index
+
+        im = image.convert('RGB')
+        im.paste(self.layer, (0, 0), self.mask)
+
+        draw = ImageDraw.Draw(im)
+        d = 2
+        for r in self.Rows(index, index):
+            x, y = self.table.x[r], self.table.y[r]
+            draw.rectangle((x-d, y-d, x+d, y+d), \
+                           fill = self.colours[self.row_track[r]])
+
+        return im
+
 def threshold2(frame, threshold):
     '''Returns a list of the pixel indicies of all of the pixels in the image
     whose value is below the given threshold. Requires 'im_array' to be a 2D
@@ -172,7 +753,7 @@ def threshold2(frame, threshold):
 
     frame = frame.point(lambda p: p < threshold)
 
-    im_array = fromimage(frame).astype('float')
+    im_array = fromimage(frame).astype(bool)
 
     try:
         B = argwhere(im_array)
@@ -188,31 +769,210 @@ def threshold2(frame, threshold):
         
     return points
 
+def frame_array(frame):
+    '''Returns the frame as a 2D numpy array. PIL images are converted, arrays
+    are returned as they are.'''
+    if isinstance(frame, ndarray):
+        return frame
+    return asarray(frame)
+
+def threshold_mask(frame, threshold):
+    '''Returns a boolean array, the same shape as the frame, that is True for
+    every pixel whose value is below the given threshold.'''
+    return frame_array(frame) < threshold
+
+def label_blobs(mask):
+    '''Labels the groups of adjacent True pixels in the boolean array 'mask'.
+    Returns (labels, n), where labels is an integer array the shape of mask
+    holding 0 for the background and 1..n for each group. Groups are numbered
+    in the order their first pixel is met scanning row by row, which is the
+    order group_points returns them in for the output of threshold2.'''
+    return ndimage.label(mask, structure = CONNECTIVITY)
+
+def blob_properties(labels, n):
+    '''Returns the centers, areas and bounding boxes of the n groups in the
+    label array 'labels' (see label_blobs) as three arrays:
+
+    centers :   (n, 2) float array of (x, y), the mean pixel position.
+    areas :     (n,) integer array, the number of pixels in each group.
+    bboxes :    (n, 4) integer array of (x0, y0, x1, y1), with x1 and y1 one
+                past the last pixel, as in a PIL bbox.'''
+    ys, xs = nonzero(labels)
+    ids = labels[ys, xs]
+
+    areas = bincount(ids, minlength = n+1)[1:]
+    centers = zeros((n, 2))
+    bboxes = zeros((n, 4), dtype = int)
+    if n == 0:
+        return centers, areas, bboxes
+
+    centers[:, 0] = bincount(ids, xs, n+1)[1:] / areas
+    centers[:, 1] = bincount(ids, ys, n+1)[1:] / areas
+
+    for k, (rows, cols) in enumerate(ndimage.find_objects(labels, n)):
+        bboxes[k] = (cols.start, rows.start, cols.stop, rows.stop)
+
+    return centers, areas, bboxes
+
+def find_blobs(frame, threshold):
+    '''Thresholds and labels the frame in one pass and returns the centers,
+    areas and bounding boxes of each spot, as described in blob_properties.
+    Gives the same spots as threshold2, group_points and center_of_clusters
+    used one after the other.'''
+    labels, n = label_blobs(threshold_mask(frame, threshold))
+    return blob_properties(labels, n)
+
+def blob_intensities(frame, labels, n):
+    '''Returns the mean pixel value of each of the n labelled groups in the
+    label array 'labels' (see label_blobs).'''
+    if n == 0:
+        return zeros(0)
+    return asarray(ndimage.mean(frame_array(frame), labels, arange(1, n+1)))
+
+def frame_blobs(frame, threshold, localization = 'centroid'):
+    '''Returns (centers, areas, intensities) for the spots found in the frame:
+    the list of (x, y) centers as used in Multiple_Spot_Track.spots, and
+    arrays of the area and mean pixel value of each spot. The centers are
+    found by the given localization method (see BrownianLocalize). Frames
+    of more than TILED_PIXELS pixels are worked on a tile at a time (see
+    BrownianTiles).'''
+    frame = frame_array(frame)
+    if frame.size > TILED_PIXELS:
+        return tiled_blobs(frame, threshold, localization)
+    labels, n = label_blobs(threshold_mask(frame, threshold))
+    centers, areas, bboxes = blob_properties(labels, n)
+    centers = refine_centers(frame, labels, n, centers, threshold, \
+                             localization)
+    return [tuple(c) for c in centers.tolist()], areas, \
+           blob_intensities(frame, labels, n)
+
+def frame_spots(frame, threshold):
+    '''Returns the list of (x, y) centers of the spots found in the frame, as
+    used in Multiple_Spot_Track.spots.'''
+    centers, areas, bboxes = find_blobs(frame, threshold)
+    return [tuple(c) for c in centers.tolist()]
+
+#The frame source read by the worker processes of parallel_find_spots.
+worker_frames = None
+
+def init_worker(frames):
+    '''Runs once in each worker process to hand it the frame source, opened
+    again in the worker (see Frame_Sequence.Reopened).'''
+    global worker_frames
+    worker_frames = frames.Reopened()
+
+def find_spots_in_chunk((indices, threshold, localization)):
+    '''Returns the spots found in the listed frames of worker_frames, as
+    given by frame_blobs.'''
+    return [frame_blobs(worker_frames.Get_array(i), threshold, localization)
+            for i in indices]
+
+def track_time_chunk(frames, (start, first, last, offset, threshold, \
+                                localization, max_frames, max_dist, linking, \
+                                record)):
+    '''Finds and links the spots in frames start to last-1 of the frame
+    source 'frames', whose frame i is held as frame i-offset, for
+    Multiple_Spot_Track.Track_in_chunks. Returns (first, last, blobs, tracks,
+    spots, states, active), where:
+
+    blobs :     the (centers, areas, intensities) found in each frame from
+                first to last-1, as given by frame_blobs.
+    tracks :    every track begun, numbered in the order they began.
+    spots :     for each track, the place of each of its spots among the
+                spots found in its frame.
+    states :    a dictionary giving, after each of the frames first-1 to
+                first+record-1, the list of (number, (index, center)) of the
+                live tracks and their last entries.
+    active :    the numbers of the tracks still live at the end.'''
+    blobs, tracks, spots, states = [], [], [], {}
+    def add_spot(number, index, j):
+        if number == len(spots):
+            spots.append([])
+        spots[number].append(j)
+    linker = Spot_Linker(max_frames, max_dist, linking, record = add_spot)
+    if start == first:
+        states[first - 1] = []
+
+    for i in xrange(start, last):
+        found = frame_blobs(frames.Get_array(i - offset), threshold, \
+                            localization)
+        if i >= first:
+            blobs.append(found)
+        ended, started = linker.Add_frame(i, found[0])
+        tracks.extend(started)
+        if first - 1 <= i < first + record:
+            states[i] = [(linker.Number(track), track[-1]) \
+                         for track in linker.active]
+
+    active = [linker.Number(track) for track in linker.active]
+    return first, last, blobs, tracks, spots, states, active
+
+def track_chunk_in_worker(job):
+    '''Runs track_time_chunk on worker_frames.'''
+    return track_time_chunk(worker_frames, job)
+
+def parallel_find_spots(frames, indices, threshold, processes = None, \
+                        chunk_size = 16, localization = 'centroid', \
+                        profile = None):
+    '''Finds the spots in the frames of the frame source 'frames' whose
+    indices are listed, using a pool of worker processes, each given
+    chunk_size frames at a time. Returns the (centers, areas, intensities)
+    found in each frame by frame_blobs, in order. Workers read files
+    themselves; frames that are only held in memory are first copied into
+    shared memory, so no pixels are sent to the workers. If a Profile is
+    given, its progress function is told as each chunk is finished.'''
+    indices = list(indices)
+    if len(indices) == 0:
+        return []
+    if frames.in_memory:
+        frames, indices = Shared_Frames(frames, indices), range(len(indices))
+
+    chunks = [(indices[k:k+chunk_size], threshold, localization)
+              for k in xrange(0, len(indices), chunk_size)]
+
+    pool = Pool(processes, initializer = init_worker, initargs = (frames,))
+    try:
+        spots = []
+        for chunk_spots in pool.imap(find_spots_in_chunk, chunks):
+            spots.extend(chunk_spots)
+            if profile is not None:
+                profile.Progress('detect', len(spots), len(indices))
+    except:
+        #Cancelled or failed: the chunks still queued are not wanted.
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+    return spots
+
 def group_points(points):
     '''Returns a list of lists of tuples, each containing the points in the list
-    of tuples 'points' that are adjacent to eachother.'''
+    of tuples 'points' that are adjacent to eachother. Groups are ordered by
+    their first point in 'points'.'''
 
-    points_list = points[:]
-    
-    groups = []
+    if len(points) == 0:
+        return []
 
-    while len(points_list) > 0:
-        
-        new_group = [points_list[0]]
-        del points_list[0]
-        i = 0
-        while len(new_group) > i:
-            (x, y) = new_group[i]
-            j = 0
-            while j < len(points_list):
-                point = points_list[j]
-                if x-2 < point[0] < x+2 and y-2 < point[1] < y+2:
-                    new_group.append(point)
-                    del points_list[j]
-                    j -= 1 
-                j += 1
-            i += 1
-        groups.append(new_group)
+    xy = array(points)
+    (xmin, ymin), (xmax, ymax) = xy.min(0), xy.max(0)
+
+    mask = zeros((ymax-ymin+1, xmax-xmin+1), dtype = bool)
+    mask[xy[:, 1]-ymin, xy[:, 0]-xmin] = True
+    labels, n = label_blobs(mask)
+    ids = labels[xy[:, 1]-ymin, xy[:, 0]-xmin]
+
+    #Keep the groups, and the points within them, in the order they appear.
+    first = unique(ids, return_index = True)[1]
+    order = argsort(ids, kind = 'mergesort')
+    sizes = bincount(ids)[1:]
+    starts = concatenate(([0], sizes.cumsum()[:-1]))
+
+    groups = []
+    for k in argsort(first):
+        members = order[starts[k]:starts[k]+sizes[k]]
+        groups.append([points[m] for m in members])
 
     return groups
 
@@ -220,10 +980,7 @@ def find_center2(tups):
     '''Take in a list of 2-tuples. Find the center of the coordinates those
        2-tuples represent and return the center as a 2-tuple of floats.'''
 
-    x, y = 0, 0
-    for t in tups:
-        x, y = x + t[0], y + t[1]
-    x, y = float(x) / len(tups), float(y) / len(tups)
+    x, y = array(tups, dtype = float).mean(0)
 
     return (x, y)
 
@@ -231,13 +988,87 @@ def center_of_clusters(groups):
     '''Returns a list of the vector average of each list of tuples in the list
     groups.'''
 
-    centers = []
+    if len(groups) == 0:
+        return []
+
+    sizes = array([len(group) for group in groups])
+    xy = array(concatenate(groups), dtype = float).reshape(-1, 2)
+    ids = repeat(arange(len(groups)), sizes)
+
+    x = bincount(ids, xy[:, 0]) / sizes
+    y = bincount(ids, xy[:, 1]) / sizes
+
+    return zip(x.tolist(), y.tolist())
+
+def link_spots(positions, centers, max_distance, method = 'nearest'):
+    '''Matches the last known positions of the tracks to the spots found in
+    the next frame. Returns a list of (k, j) pairs joining positions[k] to
+    centers[j], where each position and each center is used at most once and
+    no pair is max_distance or more apart. The method is either 'nearest', in
+    which the closest pairs are joined first, or 'optimal', in which the total
+    distance of the joins is as small as possible.'''
+
+    if len(positions) == 0 or len(centers) == 0:
+        return []
+
+    pairs = cKDTree(positions).sparse_distance_matrix(cKDTree(centers), \
+                                max_distance, output_type = 'ndarray')
+    pairs = pairs[pairs['v'] < max_distance]
+
+    if method == 'optimal':
+        return optimal_joins(pairs, max_distance)
+
+    joins = []
+    used_positions, used_centers = set(), set()
+    for n in argsort(pairs['v'], kind = 'mergesort'):
+        k, j = int(pairs['i'][n]), int(pairs['j'][n])
+        if k not in used_positions and j not in used_centers:
+            joins.append((k, j))
+            used_positions.add(k)
+            used_centers.add(j)
 
-    for group in groups:
-        center = find_center2(group)
-        centers.append(center)
+    return joins
 
-    return centers
+def optimal_joins(pairs, max_distance):
+    '''Returns the (k, j) joins, from the candidate pairs found by link_spots,
+    that give the smallest total distance. Tracks and spots are split into
+    groups that share no candidate pairs and each group is solved on its own,
+    so crowded frames stay fast.'''
+
+    rows, row_index = unique(pairs['i'], return_inverse = True)
+    cols, col_index = unique(pairs['j'], return_inverse = True)
+
+    graph = coo_matrix((ones(len(pairs)), (row_index, col_index + len(rows))),\
+                       shape = (len(rows)+len(cols),)*2)
+    n, group = connected_components(graph, directed = False)
+    pair_group = group[row_index]
+
+    #Pairs that are too far apart cost more than any set of real joins.
+    too_far = max_distance*(len(pairs)+1)
+
+    joins = []
+    order = argsort(pair_group, kind = 'mergesort')
+    sizes = bincount(pair_group, minlength = n)
+    start = 0
+    for size in sizes:
+        members = order[start:start+size]
+        start += size
+        if size == 1:
+            m = members[0]
+            joins.append((int(rows[row_index[m]]), int(cols[col_index[m]])))
+            continue
+
+        r_ids, r = unique(row_index[members], return_inverse = True)
+        c_ids, c = unique(col_index[members], return_inverse = True)
+        cost = full((len(r_ids), len(c_ids)), too_far)
+        cost[r, c] = pairs['v'][members]
+
+        best_r, best_c = linear_sum_assignment(cost)
+        for a, b in zip(best_r, best_c):
+            if cost[a, b] < too_far:
+                joins.append((int(rows[r_ids[a]]), int(cols[c_ids[b]])))
+
+    return joins
 
 def distance((x1, y1),(x2, y2)):
     '''Returns the distance between the two tuples representing cartesian
@@ -247,9 +1078,14 @@ def distance((x1, y1),(x2, y2)):
     
     return dist
 
-def draw_chain(paths, image, index):
+def chain_colour(i, num_paths):
+    '''Returns the colour draw_chain gives the i'th of num_paths paths.'''
+    return (255-(255*i)/num_paths, 0, (255*i)/num_paths)
+
+def draw_chain(paths, image, index, colours = None):
     '''Returns a copy of the image 'image' with each path in the list 'paths'
-    drawn up to the the given index.'''
+    drawn up to the the given index, in the colour given for it in the list
+    'colours', or by default shading from red to blue along the list.'''
 
     im = image.copy().convert('RGB')
     
@@ -257,19 +1093,18 @@ def draw_chain(paths, image, index):
     
     num_paths = len(paths)
     d = 2
+    if colours is None:
+        colours = [chain_colour(i, num_paths) for i in xrange(num_paths)]
 
-    i = 0
-    for path in paths:
+    for (path, colour) in zip(paths, colours):
         points = []
         for point in path:
             if point[0] <= index:
                 points.append(point[1])
             if point[0] == index:
                 x, y = point[1]
-                draw.rectangle((x-d, y-d, x+d, y+d), fill =\
-                    (255-(255*i)/num_paths, 0, (255*i)/num_paths))
+                draw.rectangle((x-d, y-d, x+d, y+d), fill = colour)
         
-        draw.line(points, fill =(255-(255*i)/num_paths, 0, (255*i)/num_paths))
-        i += 1
+        draw.line(points, fill = colour)
     
     return im
@@ -4,62 +4,26 @@ spot through a sequence of frames and then displaying, saving or plotting this
 information. This program is distributed with the hope that it might be found
 useful, but with no warranty, not even the implied warranty of usefulness for
 a specific purpose. This file contains the supporting tools used by the main
-program.
+program: the spot search and drawing of BrownianSearch, and the plotting.
 
 Author: Donald J Woodbury, University of Toronto'''
 
 from Tkinter import *
 from PIL import Image, ImageSequence, ImageDraw, ImageTk
 from numpy import average
+from BrownianSearch import frame_window, points_below_threshold, \
+     window_center, window_centers, nearest_blob_center, Spot_Predictor, \
+     draw_point, draw_points, cluster_center
 from pylab import plot, xlabel, ylabel, show, title
 
-def points_below_threshold(image, threshold, bbox):
-    '''Returns a list of the pixel indicies of all of the pixels in the image
-    bounded by the bbox whose value is below the given threshold.'''
-
-    pix = image.load()
-    (xsize, ysize) = image.size
-
-    points = []
-
-    for x in xrange(max(0, bbox[0]), min(xsize, bbox[2])):
-        for y in xrange(max(0, bbox[1]), min(ysize, bbox[3])):
-            if pix[x,y] < threshold:
-                points.append((x, y))
-    
-    return points
-
-def draw_point(point, image):
-    '''Returns a copy of the image 'image' with each point in the list 'points'
-    drawn as a red pixel drawn on the image.'''
-
-    image = image.convert('RGB')
-    pix = image.load()
-
-    for x in xrange(max(0, int(point[0]) - 2),\
-                    min(int(point[0]) + 3, image.size[0])):
-        for y in xrange(max(0, int(point[1]) - 2),\
-                    min(int(point[1]) + 3, image.size[1])):
-            pix[x, y] = (255, 0, 0)
-    
-    return image
-
-def cluster_center(points):
-    '''returns the vector average the (x,y) tuples in the list points.'''
-    
-    x, y = zip(*points)
-    
-    xavg = average(x)
-    yavg = average(y)
-
-    return [xavg, yavg]
-
 class Plot_track:
-    def __init__(self, track):
+    def __init__(self, track, others = ()):
         '''Creates a Tkinter window that allows the user to enter the plot
-        labels. Once the user accepts these values, a pylab plot is launched.'''
+        labels. Once the user accepts these values, a pylab plot is launched.
+        The tracks in the list 'others', if any, are plotted with 'track'.'''
 
         self.track = track
+        self.others = others
         
         self.window = Tk()
         self.window.title("Plot Labels")
@@ -98,9 +62,11 @@ class Plot_track:
         '''launches a pylab plot of the track.'''
         self.window.destroy()
 
-        x , y = zip(*self.track)
-        
-        plot(x, y)
+        for track in [self.track] + list(self.others):
+            if len(track) == 0:
+                continue
+            x , y = zip(*track)
+            plot(x, y)
         xlabel(self.x_label.get())
         ylabel(self.y_label.get())
         title(self.title.get())